@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+Compact binary archives of sim runs, and a memory-mapped reader for them.
+
+sim.py --archive FILE writes every download and upload of a run to FILE as
+it goes (one file per iteration when there are several).  Reading one back
+maps the file into memory, so only the rounds that are looked at get read
+from disk:
+
+    with Archive("run.wza") as a:
+        a.rounds                          # number of rounds
+        a.downloads(10)                   # [Download] in round 10
+        a.downloads_to(10, "WalziStd0")   # ... to one peer
+        a.uploads_from(10, "Seed0")       # [Upload] from one peer
+        a.blocks_between("Seed0", "WalziStd0")   # total over all rounds
+
+Run "python archive.py FILE" for a summary of an archive.
+
+Format, all little-endian:
+    "WALZIAR1"
+    one block per round:
+        header: n_downloads, n_uploads (uint32), typecode of the blocks and
+            bw columns (1 byte each, 'I' or 'd'), 6 bytes of padding
+        downloads, in columns: from, to, piece (uint32), blocks
+        uploads, in columns: from (the uploader), to (uint32), bw
+        Every column starts on an 8 byte boundary.  Peers are stored as
+        indexes into the ids in the metadata.  Downloads are sorted by
+        downloader and uploads by uploader, in peer order.
+    round offsets: uint64 per round, where each round's block starts
+    metadata: JSON -- ids, peers, config, seed, hash_seed (PYTHONHASHSEED),
+        upload rates, round_done
+    trailer: offsets position, number of rounds, metadata position and
+        length (uint64 each), then "WALZIAR1" again
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from messages import Upload, Download
+from util import int_if_whole
+
+MAGIC = b"WALZIAR1"
+ROUND_HEADER = struct.Struct("<IIcc6x")
+TRAILER = struct.Struct("<QQQQ8s")
+
+
+# Columns are mapped as is on little-endian machines, and byte swapped
+# going in and out everywhere else
+SWAP = sys.byteorder != "little"
+
+
+def _pad(n):
+    return (-n) % 8
+
+
+def _little_endian(col):
+    """An array in the archive's byte order"""
+    if SWAP:
+        col = array(col.typecode, col)
+        col.byteswap()
+    return col
+
+
+def _cast(view, code):
+    """
+    A column of the archive as code values: the memoryview itself on a
+    little-endian machine, a byte-swapped copy otherwise
+    """
+    if not SWAP:
+        return view.cast(code)
+    col = array(code, bytes(view))
+    col.byteswap()
+    return col
+
+
+def _config_meta(conf):
+    """The settings of conf that can be saved as JSON"""
+    ans = dict()
+    for (k, v) in vars(conf).items():
+        if k.startswith("_") or k == "agent_classes":
+            continue
+        try:
+            json.dumps(v)
+        except TypeError:
+            continue
+        ans[k] = v
+    return ans
+
+
+class ArchiveWriter:
+    """Writes one run, a round at a time, as the sim produces it"""
+    def __init__(self, path, conf, meta=None):
+        self.path = path
+        self.conf = conf
+        self.meta = dict(meta or ())
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.position = self.f.tell()
+        self.offsets = array("Q")
+
+    def begin(self, peer_ids, upload_rates):
+        self.peer_ids = peer_ids[:]
+        self.ids = peer_ids[:]
+        self.id_index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.upload_rates = dict(upload_rates)
+
+    def index_of(self, peer_id):
+        if peer_id not in self.id_index:
+            self.id_index[peer_id] = len(self.ids)
+            self.ids.append(peer_id)
+        return self.id_index[peer_id]
+
+    def _column(self, values, code=None):
+        """Pack values, picking the typecode if none is given"""
+        if code is None:
+            code = "I"
+            try:
+                col = array(code, values)
+            except (OverflowError, TypeError):
+                code = "d"
+                col = array(code, values)
+        else:
+            col = array(code, values)
+        data = _little_endian(col).tobytes()
+        return (code, data + b"\0" * _pad(len(data)))
+
+    def write_round(self, downloads, uploads):
+        """
+        downloads: dict : peer_id -> [Download] to that peer
+        uploads: dict : peer_id -> [Upload] from that peer
+        """
+        index_of = self.index_of
+        dls = [d for pid in self.peer_ids for d in downloads[pid]]
+        # Uploads are filed under the peer that made them
+        ups = [(i, u) for (i, pid) in enumerate(self.peer_ids)
+               for u in uploads[pid]]
+        (blocks_code, blocks) = self._column([d.blocks for d in dls])
+        (bw_code, bws) = self._column([u.bw for (_, u) in ups])
+        parts = [ROUND_HEADER.pack(len(dls), len(ups),
+                                   blocks_code.encode(), bw_code.encode()),
+                 self._column([index_of(d.from_id) for d in dls], "I")[1],
+                 self._column([index_of(d.to_id) for d in dls], "I")[1],
+                 self._column([d.piece for d in dls], "I")[1],
+                 blocks,
+                 self._column([i for (i, _) in ups], "I")[1],
+                 self._column([index_of(u.to_id) for (_, u) in ups], "I")[1],
+                 bws]
+        self.offsets.append(self.position)
+        self.f.write(b"".join(parts))
+        self.position = self.f.tell()
+
+    def finish(self, round_done):
+        """Write the index and metadata, and close the file"""
+        f = self.f
+        offsets_pos = f.tell()
+        f.write(_little_endian(self.offsets).tobytes())
+        meta = dict(self.meta)
+        meta.update({"ids": self.ids,
+                     "peers": len(self.peer_ids),
+                     "config": _config_meta(self.conf),
+                     "upload_rates": self.upload_rates,
+                     "round_done": round_done})
+        data = json.dumps(meta, sort_keys=True).encode("utf-8")
+        meta_pos = f.tell()
+        f.write(data)
+        f.write(TRAILER.pack(offsets_pos, len(self.offsets), meta_pos,
+                             len(data), MAGIC))
+        f.close()
+
+    def abort(self):
+        """Close without finishing.  The file is left unreadable."""
+        self.f.close()
+
+    # Writers are saved in checkpoints without their file
+    def __getstate__(self):
+        if not self.f.closed:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        state = dict(self.__dict__)
+        state["f"] = None
+        return state
+
+    def reopen(self):
+        """
+        Carry on writing after being loaded from a checkpoint.  Everything
+        written after the checkpoint was saved is cut off.
+        """
+        self.f = open(self.path, "r+b")
+        self.f.truncate(self.position)
+        self.f.seek(self.position)
+
+
+class _Round:
+    """The columns of one round, as memoryviews into the map"""
+    def __init__(self, buf, pos):
+        (n_dl, n_up, blocks_code, bw_code) = ROUND_HEADER.unpack_from(buf, pos)
+        pos += ROUND_HEADER.size
+
+        def column(code, n):
+            nonlocal pos
+            size = n * struct.calcsize(code)
+            col = _cast(buf[pos:pos + size], code)
+            pos += size + _pad(size)
+            return col
+
+        self.dl_from = column("I", n_dl)
+        self.dl_to = column("I", n_dl)
+        self.dl_piece = column("I", n_dl)
+        self.dl_blocks = column(blocks_code.decode(), n_dl)
+        self.up_from = column("I", n_up)
+        self.up_to = column("I", n_up)
+        self.up_bw = column(bw_code.decode(), n_up)
+
+
+class Archive:
+    """Read-only, memory-mapped view of an archive written by ArchiveWriter"""
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.map)
+        if self.buf[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a sim archive" % path)
+        if len(self.buf) < len(MAGIC) + TRAILER.size:
+            self.close()
+            raise ValueError("%s is incomplete" % path)
+        (offsets_pos, rounds, meta_pos, meta_len, magic) = TRAILER.unpack_from(
+            self.buf, len(self.buf) - TRAILER.size)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is incomplete: the run didn't finish" % path)
+        self.rounds = rounds
+        self.offsets = _cast(self.buf[offsets_pos:offsets_pos + 8 * rounds],
+                             "Q")
+        self.meta = json.loads(bytes(self.buf[meta_pos:meta_pos + meta_len]))
+        self.ids = self.meta["ids"]
+        self.peer_ids = self.ids[:self.meta["peers"]]
+        self.id_index = dict((pid, i) for (i, pid) in enumerate(self.ids))
+        self.config = self.meta["config"]
+        self.upload_rates = self.meta["upload_rates"]
+        self.round_done = self.meta["round_done"]
+
+    def close(self):
+        self.offsets = None
+        self.buf.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Columns from round() are still in use.  The map is closed
+            # when the last of them goes away.
+            pass
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def round(self, r):
+        if r < 0:
+            r += self.rounds
+        if r < 0 or r >= self.rounds:
+            raise IndexError("round index out of range")
+        return _Round(self.buf, self.offsets[r])
+
+    def _downloads(self, rd, lo, hi):
+        ids = self.ids
+        return [Download(ids[rd.dl_from[k]], ids[rd.dl_to[k]], rd.dl_piece[k],
+                         int_if_whole(rd.dl_blocks[k]))
+                for k in range(lo, hi)]
+
+    def _uploads(self, rd, lo, hi):
+        ids = self.ids
+        return [Upload(ids[rd.up_from[k]], ids[rd.up_to[k]],
+                       int_if_whole(rd.up_bw[k]))
+                for k in range(lo, hi)]
+
+    def downloads(self, r):
+        rd = self.round(r)
+        return self._downloads(rd, 0, len(rd.dl_to))
+
+    def uploads(self, r):
+        rd = self.round(r)
+        return self._uploads(rd, 0, len(rd.up_from))
+
+    def downloads_to(self, r, peer_id):
+        rd = self.round(r)
+        i = self.id_index[peer_id]
+        return self._downloads(rd, bisect_left(rd.dl_to, i),
+                               bisect_right(rd.dl_to, i))
+
+    def uploads_from(self, r, peer_id):
+        rd = self.round(r)
+        i = self.id_index[peer_id]
+        return self._uploads(rd, bisect_left(rd.up_from, i),
+                             bisect_right(rd.up_from, i))
+
+    def blocks_between(self, from_id, to_id, rounds=None):
+        """
+        Blocks to_id downloaded from from_id over the given rounds (an
+        iterable of round numbers; all of them by default)
+        """
+        f = self.id_index[from_id]
+        t = self.id_index[to_id]
+        total = 0
+        for r in (range(self.rounds) if rounds is None else rounds):
+            rd = self.round(r)
+            for k in range(bisect_left(rd.dl_to, t), bisect_right(rd.dl_to, t)):
+                if rd.dl_from[k] == f:
+                    total += rd.dl_blocks[k]
+        return int_if_whole(total)
+
+    def blocks_uploaded(self):
+        """dict : peer_id -> blocks uploaded over the whole run"""
+        totals = [0] * len(self.ids)
+        for r in range(self.rounds):
+            rd = self.round(r)
+            for (i, b) in zip(rd.dl_from, rd.dl_blocks):
+                totals[i] += b
+        return dict((pid, int_if_whole(totals[i]))
+                    for (i, pid) in enumerate(self.peer_ids))
+
+
+def main(args):
+    if len(args) != 2:
+        print("Usage: %s ARCHIVE" % args[0])
+        sys.exit(1)
+    with Archive(args[1]) as a:
+        print("%d rounds, %d peers" % (a.rounds, len(a.peer_ids)))
+        for k in sorted(a.meta):
+            if k not in ("ids", "upload_rates", "round_done", "config"):
+                print("%s: %s" % (k, a.meta[k]))
+        print("config: %s" % json.dumps(a.config, sort_keys=True))
+        uploaded = a.blocks_uploaded()
+        print("peer: uploaded blocks, upload rate, round done")
+        for pid in a.peer_ids:
+            print("%s: %s, %s, %s" % (pid, uploaded[pid],
+                                      a.upload_rates.get(pid),
+                                      a.round_done.get(pid)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+A disk cache of iteration results, so running the same sim, sweep or
+tournament again only recomputes what changed.
+
+With --cache DIR, every iteration is looked up before it's run.  The key is
+a hash of:
+  - the settings that affect the result (so not --iters, --workers,
+    profiling, ...)
+  - the source of each agent class's module, and of the modules of the
+    classes it inherits from
+  - the iteration's seed, and PYTHONHASHSEED
+  - the sim version: the source of the sim's own modules
+so after editing one agent, only the runs it's in are recomputed.  The
+value is the iteration's Stats.summary, in one small JSON file per key.
+
+Runs that write an archive or checkpoints, warm start, or are profiled
+always run, and aren't cached.  So do runs without a fixed PYTHONHASHSEED:
+agents that iterate over sets can give different results under different
+ones.
+
+The cache is kept under --cache-size megabytes by deleting the entries
+used least recently, a batch at a time.  To look after it by hand:
+
+    python cache.py DIR stats
+    python cache.py DIR clear
+    python cache.py DIR invalidate WalziStd ...   # runs with these agents
+"""
+
+import os
+import sys
+import json
+import inspect
+import hashlib
+
+from util import hash_seed
+
+# Bump when the format of the entries changes
+FORMAT = 1
+
+# The sim's own modules.  Changing any of them changes every key.
+SIM_MODULES = ["sim", "swarm", "history", "messages", "peer", "pieceset",
+               "stats", "util"]
+
+# Settings that don't change what an iteration returns.  validation,
+# validate_every and trusted don't either, for agents that keep the rules,
+# but they stay in the key: a result cached from an unvalidated run would
+# otherwise hide an agent breaking the rules from a later validated one.
+# settings() leaves them out where they make no difference.
+IGNORED = set(["iters", "workers", "seed", "profile", "profile_out",
+               "profile_format", "time_agents", "agent_times_out", "archive",
+               "checkpoint", "checkpoint_every", "resume", "warm_start",
+               "ci_width", "min_iters", "max_iters", "cache", "cache_size"])
+
+# Eviction goes down to this fraction of the size limit, so it's only
+# needed every so many puts
+LOW_WATER = 0.9
+
+_file_hashes = dict()   # path -> sha256 of the file, read once per process
+
+# cache directory -> bytes in it as of the last scan, plus what this process
+# wrote since.  Saves listing the whole directory on every put; other
+# processes' entries are counted at the next scan.
+_sizes = dict()
+
+
+def file_hash(path):
+    if path not in _file_hashes:
+        with open(path, "rb") as f:
+            _file_hashes[path] = hashlib.sha256(f.read()).hexdigest()
+    return _file_hashes[path]
+
+
+def sim_version():
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [file_hash(os.path.join(here, name + ".py"))
+            for name in SIM_MODULES]
+
+
+def agent_sources(conf):
+    """dict : agent class name -> hashes of its modules' source"""
+    ans = dict()
+    for (name, cls) in conf.agent_classes.items():
+        files = []
+        for c in cls.__mro__:
+            if c is not object:
+                path = inspect.getsourcefile(c)
+                if path not in files:
+                    files.append(path)
+        ans[name] = [file_hash(path) for path in files]
+    return ans
+
+
+def settings(conf):
+    """The settings of conf that can change an iteration's result"""
+    ans = dict((k, v) for (k, v) in vars(conf).items()
+               if not k.startswith("_") and k != "agent_classes" and
+               k not in IGNORED)
+    mode = ans.get("validation", "full")
+    if mode != "sampled":
+        ans.pop("validate_every", None)
+    if mode == "off":
+        ans.pop("trusted", None)
+    return ans
+
+
+def run_key(conf, seed):
+    """The cache key of the iteration of conf run with seed"""
+    data = {"format": FORMAT,
+            "settings": settings(conf),
+            "agents": agent_sources(conf),
+            "seed": seed,
+            "hash_seed": hash_seed(),
+            "sim": sim_version()}
+    text = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    One directory of KEY.json files.  Several processes can share it:
+    entries are written to a temporary file and renamed into place.
+    """
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """The cached Stats.summary for key, or None"""
+        path = self.file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            # Mark as recently used, for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        (uploaded, completion) = entry["summary"]
+        return (uploaded, completion)
+
+    def put(self, key, summary, agent_class_names):
+        entry = {"summary": list(summary),
+                 "agents": sorted(set(agent_class_names))}
+        path = self.file(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+            size = f.tell()
+        os.replace(tmp, path)
+        if self.max_bytes is None:
+            return
+        where = os.path.abspath(self.path)
+        if where in _sizes:
+            _sizes[where] += size
+        else:
+            _sizes[where] = self.stats()[1]
+        if _sizes[where] > self.max_bytes:
+            self.evict(int(self.max_bytes * LOW_WATER))
+
+    def entries(self):
+        """[(last used, size, path)] of every entry, oldest first"""
+        ans = []
+        for e in os.scandir(self.path):
+            if not e.name.endswith(".json"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            ans.append((st.st_mtime, st.st_size, e.path))
+        ans.sort()
+        return ans
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Another process got there first
+            pass
+
+    def evict(self, max_bytes):
+        """Delete the least recently used entries until under max_bytes"""
+        entries = self.entries()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= max_bytes:
+                break
+            self.remove(path)
+            total -= size
+        _sizes[os.path.abspath(self.path)] = total
+
+    def clear(self):
+        entries = self.entries()
+        for (_, _, path) in entries:
+            self.remove(path)
+        _sizes.pop(os.path.abspath(self.path), None)
+        return len(entries)
+
+    def invalidate(self, class_names):
+        """Delete the entries of runs with any of these agent classes"""
+        names = set(class_names)
+        count = 0
+        for (_, _, path) in self.entries():
+            try:
+                with open(path) as f:
+                    agents = json.load(f)["agents"]
+            except (IOError, ValueError, KeyError):
+                continue
+            if names.intersection(agents):
+                self.remove(path)
+                count += 1
+        _sizes.pop(os.path.abspath(self.path), None)
+        return count
+
+    def stats(self):
+        """(number of entries, total bytes)"""
+        entries = self.entries()
+        return (len(entries), sum(size for (_, size, _) in entries))
+
+
+def main(args):
+    commands = ("stats", "clear", "invalidate")
+    if len(args) < 3 or args[2] not in commands or (
+            args[2] == "invalidate" and len(args) < 4):
+        print("Usage: %s DIR stats | clear | invalidate AgentClass ..." %
+              args[0])
+        sys.exit(1)
+    if not os.path.isdir(args[1]):
+        print("No cache at %s" % args[1])
+        sys.exit(1)
+    cache = ResultCache(args[1])
+    if args[2] == "stats":
+        (count, size) = cache.stats()
+        print("%d entries, %.1f MB" % (count, size / 1048576.0))
+    elif args[2] == "clear":
+        print("Removed %d entries" % cache.clear())
+    else:
+        print("Removed %d entries" % cache.invalidate(args[3:]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
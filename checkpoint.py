@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+"""
+Checkpoints of a run in progress, so a long run that dies can be resumed,
+and one warmed-up swarm can be the starting point of many experiments.
+
+A checkpoint is a pickle of everything the sim needs to carry on from the
+start of a round: the agents, the swarm state, the history (and the
+archive writer, if any) and the state of the random module.  Agents must
+therefore be picklable: no lambdas or open files in their state (see
+util.Constant for defaultdict factories).
+
+    sim.py --checkpoint run.ckpt ...            # save every 100 rounds
+    sim.py --checkpoint run.ckpt --resume ...   # carry on after a crash
+
+Resuming restores the random state too, so the run goes on exactly as it
+would have.  --warm-start FILE instead continues from FILE with each
+iteration's own seed, so the iterations diverge from a common start.
+"""
+
+import os
+import pickle
+
+VERSION = 1
+
+
+def save_checkpoint(path, data):
+    """Write data to path, replacing it only once the new one is complete"""
+    data = dict(data, version=VERSION)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        raise ValueError("%s is not a checkpoint this version of the sim"
+                         " can read" % path)
+    return data
+
+
+def check_compatible(data, conf):
+    """Raise ValueError if the checkpoint is from a different kind of run"""
+    saved = data["config"]
+    for k in ("agent_class_names", "num_pieces", "blocks_per_piece",
+              "engine"):
+        if saved.get(k) != getattr(conf, k, None):
+            raise ValueError("Checkpoint was saved with %s=%s, not %s" % (
+                k, saved.get(k), getattr(conf, k, None)))
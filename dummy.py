@@ -16,15 +16,17 @@ from peer import Peer
 class Dummy(Peer):
 
     def post_init(self):
-        print(("post_init(): %s here!" % self.id))
+        logging.debug("post_init(): %s here!", self.id)
         self.dummy_state = dict()
         self.dummy_state["cake"] = "lie"
 
     def requests(self, peers, history):
         """
-        peers: available info about the peers (who has what pieces)
+        peers: available info about the peers (who has what pieces).  A
+            read-only sequence of PeerInfo, shared with the sim.
         history: what's happened so far as far as this peer can see
-        returns: a list of Request() objects
+        returns: a list of Request() objects, or a RequestBatch (see
+            messages.py; cheaper when there are thousands of requests)
         This will be called after update_pieces() with the most recent state.
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
@@ -32,16 +34,18 @@ class Dummy(Peer):
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
+        logging.debug("%s still here. Here are some peers:", self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        # Passing the history as an argument means it only gets formatted
+        # when debug logging is actually on.
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -49,7 +53,8 @@ class Dummy(Peer):
 
         # Sort peers by id.  This is probably not a useful sort, but other
         # sorts might be useful
-        peers.sort(key=lambda p: p.id)
+        # (peers is a read-only view, so sort into a new list)
+        peers = sorted(peers, key=lambda p: p.id)
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
@@ -75,16 +80,18 @@ class Dummy(Peer):
         peers -- available info about all the peers
         history -- history for all previous rounds
         returns: list of Upload objects.
-        In each round, this will be called after requests().
+        In each round, this will be called after requests().  Rounds where
+        no one sent this peer requests are skipped, unless the class sets
+        idle_calls (see peer.py).
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
-        # the previous round.
+        # the previous round.  For totals per peer, history.received_from(window=k)
+        # and history.sent_to(window=k) are much cheaper than adding those up.
 
         if len(requests) == 0:
             logging.debug("No one wants my pieces!")
@@ -1,7 +1,205 @@
 #!/usr/bin/python
 
-import copy
+"""
+The record of every download and upload in a sim run.
+
+History stores them in columns -- growable typed arrays with one entry per
+download (from, to, piece, blocks) or upload (from, to, bw) -- rather than
+as Download and Upload objects, which take ten times the memory on long
+runs.  Rows are grouped by round, and within a round by peer (the
+downloader for downloads, the uploader for uploads), so one peer's rows for
+one round are a contiguous slice found through per-round offsets.
+
+Agents still see history.downloads[round] and history.uploads[round] as
+lists of Download / Upload objects.  Those lists are built from the columns
+when they are asked for.
+"""
+
 import pprint
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+from messages import Upload, Download
+from util import int_if_whole
+
+
+# Column type codes, narrowest first.  Columns start out narrow and are
+# widened the first time a value doesn't fit.
+WIDTHS = ["H", "i", "d"]
+
+
+class _Table:
+    """
+    One kind of transfer, in columns: dict : column name -> array, one entry
+    per row.  Peer ids are stored as indexes into History.ids.
+
+    Rows are appended a round at a time, grouped by peer index, and
+    offsets[k] .. offsets[k + 1], with k = (r - first_round) * n + i, are
+    the rows of peer index i in round r, so the round of a row is implied
+    by where it is.  Rounds before first_round have been dropped.
+    """
+    def __init__(self, num_peers, names):
+        self.num_peers = num_peers
+        self.rounds = 0
+        self.first_round = 0
+        self.offsets = array("I", [0])
+        self.columns = dict((name, array(WIDTHS[0])) for name in names)
+
+    def __len__(self):
+        return self.offsets[-1] - self.offsets[0]
+
+    def rows(self, r, i):
+        k = (r - self.first_round) * self.num_peers + i
+        return range(self.offsets[k], self.offsets[k + 1])
+
+    def drop_before(self, r):
+        """Forget the rows of every round before r"""
+        k = (r - self.first_round) * self.num_peers
+        if k <= 0:
+            return
+        cut = self.offsets[k]
+        for col in self.columns.values():
+            del col[:cut]
+        self.offsets = array("I", (o - cut for o in self.offsets[k:]))
+        self.first_round = r
+
+    def extend(self, name, values):
+        col = self.columns[name]
+        n = len(col)
+        while True:
+            try:
+                col.extend(values)
+                return
+            except (OverflowError, TypeError):
+                del col[n:]
+                col = array(WIDTHS[WIDTHS.index(col.typecode) + 1], col)
+                self.columns[name] = col
+
+    def add_round(self, group_sizes):
+        """Call after extending the columns with a round's rows"""
+        end = self.offsets[-1]
+        for size in group_sizes:
+            end += size
+            self.offsets.append(end)
+        self.rounds += 1
+
+
+class _Totals:
+    """
+    Running totals of the blocks one peer exchanged with each counterpart,
+    for windowed sums.  For every counterpart index c, rounds[c] lists the
+    rounds with a transfer and cumulative[c] the running total up to and
+    including that round, so the total for any window is a difference of
+    two prefix sums.
+
+    keep: the longest window that can be asked for, or None for any.
+    Entries older than that are folded into the oldest one kept.
+    """
+    def __init__(self, keep=None):
+        self.keep = keep
+        self.rounds = dict()       # counterpart index -> array of rounds
+        self.cumulative = dict()   # counterpart index -> array of totals
+
+    def add(self, r, c, amount):
+        if c not in self.rounds:
+            self.rounds[c] = array("i", [r])
+            self.cumulative[c] = array("d", [amount])
+            return
+        rounds = self.rounds[c]
+        cumulative = self.cumulative[c]
+        if rounds[-1] == r:
+            cumulative[-1] += amount
+        else:
+            rounds.append(r)
+            cumulative.append(cumulative[-1] + amount)
+
+    def window(self, ids, current_round, window):
+        """
+        dict : counterpart id -> total over the last window rounds before
+        current_round (all of them if window is None).  Counterparts with
+        nothing in the window are left out.
+        """
+        ans = dict()
+        if window is not None and window <= 0:
+            return ans
+        if self.keep is not None and window is not None and window > self.keep:
+            raise ValueError("Only the last %d rounds are kept"
+                             " (history_window); can't sum %d"
+                             % (self.keep, window))
+        start = 0 if window is None else current_round - window
+        for (c, rounds) in self.rounds.items():
+            if rounds[-1] < start:
+                continue
+            cumulative = self.cumulative[c]
+            i = bisect_left(rounds, start)
+            total = cumulative[-1] - (cumulative[i - 1] if i > 0 else 0)
+            if total != 0:
+                ans[ids[c]] = int_if_whole(total)
+        return ans
+
+    def drop_before(self, r):
+        """
+        Forget the entries before round r, except the last one, which is
+        still needed to sum a window starting at r.
+        """
+        for (c, rounds) in self.rounds.items():
+            i = bisect_left(rounds, r)
+            if i > 1:
+                del rounds[:i - 1]
+                del self.cumulative[c][:i - 1]
+
+
+def _make_downloads(ids, t, rows):
+    c = t.columns
+    (f, to, piece, blocks) = (c["from"], c["to"], c["piece"], c["blocks"])
+    return [Download(ids[f[k]], ids[to[k]], piece[k], int_if_whole(blocks[k]))
+            for k in rows]
+
+
+def _make_uploads(ids, t, rows):
+    c = t.columns
+    (f, to, bw) = (c["from"], c["to"], c["bw"])
+    return [Upload(ids[f[k]], ids[to[k]], int_if_whole(bw[k])) for k in rows]
+
+
+class PeerRounds(Sequence):
+    """
+    One peer's downloads or uploads, as a read-only sequence with one entry
+    per round.  Each entry is a new list of Download / Upload objects.
+    """
+    __slots__ = ("table", "peer_idx", "ids", "make")
+
+    def __init__(self, table, peer_idx, ids, make):
+        self.table = table
+        self.peer_idx = peer_idx
+        self.ids = ids     # History.ids
+        self.make = make   # (ids, table, range of rows) -> [Download or Upload]
+
+    def __len__(self):
+        return self.table.rounds
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        n = len(self)
+        if r < 0:
+            r += n
+        if r < 0 or r >= n:
+            raise IndexError("round index out of range")
+        if r < self.table.first_round:
+            raise IndexError("round %d is no longer kept: only the last"
+                             " rounds are (history_window)" % r)
+        return self.make(self.ids, self.table,
+                         self.table.rows(r, self.peer_idx))
+
+    def __iter__(self):
+        """The rounds still kept, which is all of them by default"""
+        for r in range(self.table.first_round, len(self)):
+            yield self[r]
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class AgentHistory:
@@ -10,18 +208,50 @@ class AgentHistory:
 
     history.downloads: [[Download objects for round]]  (one sublist for each round)
          All the downloads _to_ this agent.
-        
+
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    Both are read-only sequences; each sublist is built when it's asked for.
+    If the sim runs with a history_window of K, only the last K rounds are
+    kept: older ones raise IndexError, and first_round() is the oldest one
+    left.  Agents declare how far back they look in Peer.lookback, and the
+    sim won't run them with a shorter window.
+
+    history.received_from(window=k) and history.sent_to(window=k) give the
+    blocks exchanged with each peer over the last k rounds, without scanning
+    the Download lists.
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, totals=None):
         """
         Pull out just the info for peer_id.
+
+        totals: (ids, received _Totals, sent _Totals), kept up to date by
+            the History
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        self.totals = totals
+
+    def received_from(self, window=None):
+        """
+        dict : peer_id -> blocks this agent downloaded from that peer in the
+        last window rounds (in all rounds if window is None).  Peers that
+        sent nothing in the window are left out.
+        """
+        (ids, received, _) = self.totals
+        return received.window(ids, self.current_round(), window)
+
+    def sent_to(self, window=None):
+        """
+        dict : peer_id -> blocks that peer downloaded from this agent in the
+        last window rounds (in all rounds if window is None).  Counts the
+        blocks actually used, which can be less than the bandwidth offered
+        in this agent's Uploads.
+        """
+        (ids, _, sent) = self.totals
+        return sent.window(ids, self.current_round(), window)
 
     def last_round(self):
         return len(self.downloads)-1
@@ -30,30 +260,66 @@ class AgentHistory:
         """ 0 is the first """
         return len(self.downloads)
 
+    def first_round(self):
+        """The oldest round still kept"""
+        return self.downloads.table.first_round
+
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pprint.pformat(list(self.downloads)),
+            pprint.pformat(list(self.uploads)))
 
 
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+    def __init__(self, peer_ids, upload_rates, window=None):
         """
+        window: if set, only the downloads and uploads of the last window
+            rounds are kept, so memory stays flat however long the run.
+            Totals over the whole run (blocks_uploaded, received_from() and
+            sent_to() with no window) are still exact.
+
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
         downloads:
                    dict : peer_id -> [[downloads] -- one list per round]
-                   
+
         Keep track of the uploads _from_ and downloads _to_ the
-        specified peer id.
+        specified peer id.  Both are views on the columns in
+        self.dl_table and self.up_table.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
+        # Peer ids stored in the columns are indexes into ids.  Ids that
+        # aren't peers (from unchecked uploads) are added as they show up.
+        self.ids = peer_ids[:]
+        self.id_index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        n = len(peer_ids)
+        self.dl_table = _Table(n, ["from", "to", "piece", "blocks"])
+        self.up_table = _Table(n, ["from", "to", "bw"])
+
+        self.window = window
+        # Windowed totals per peer index, kept up to date in update()
+        self.received = [_Totals(window) for _ in peer_ids]
+        self.sent = [_Totals(window) for _ in peer_ids]
+        self.uploaded = [0] * n    # peer index -> blocks uploaded so far
+
+        self.downloads = dict(
+            (pid, PeerRounds(self.dl_table, i, self.ids, _make_downloads))
+            for (i, pid) in enumerate(peer_ids))
+        self.uploads = dict(
+            (pid, PeerRounds(self.up_table, i, self.ids, _make_uploads))
+            for (i, pid) in enumerate(peer_ids))
+
+    def index_of(self, peer_id):
+        try:
+            return self.id_index[peer_id]
+        except KeyError:
+            self.id_index[peer_id] = len(self.ids)
+            self.ids.append(peer_id)
+            return self.id_index[peer_id]
 
     def update(self, dls, ups):
         """
@@ -62,9 +328,52 @@ class History:
 
         append these downloads to to the history
         """
-        for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+        index_of = self.index_of
+        dls = [dls[pid] for pid in self.peer_ids]
+        rows = [d for ds in dls for d in ds]
+        t = self.dl_table
+        t.extend("from", [index_of(d.from_id) for d in rows])
+        t.extend("to", [index_of(d.to_id) for d in rows])
+        t.extend("piece", [d.piece for d in rows])
+        t.extend("blocks", [d.blocks for d in rows])
+        t.add_round(len(ds) for ds in dls)
+        self.update_totals(t.rounds - 1, rows)
+
+        ups = [ups[pid] for pid in self.peer_ids]
+        rows = [u for us in ups for u in us]
+        t = self.up_table
+        t.extend("from", [index_of(u.from_id) for u in rows])
+        t.extend("to", [index_of(u.to_id) for u in rows])
+        t.extend("bw", [u.bw for u in rows])
+        t.add_round(len(us) for us in ups)
+
+        # Trim back to the window once twice its worth has built up, so the
+        # copying averages out to a little per round.
+        kept = t.rounds - t.first_round
+        if self.window is not None and kept >= 2 * self.window:
+            self.drop_before(t.rounds - self.window)
+
+    def drop_before(self, r):
+        self.dl_table.drop_before(r)
+        self.up_table.drop_before(r)
+        for totals in self.received + self.sent:
+            totals.drop_before(r)
+
+    def update_totals(self, r, downloads):
+        n = len(self.peer_ids)
+        index_of = self.index_of
+        for d in downloads:
+            i = index_of(d.to_id)
+            j = index_of(d.from_id)
+            if i < n:
+                self.received[i].add(r, j, d.blocks)
+            if j < n:
+                self.sent[j].add(r, i, d.blocks)
+                self.uploaded[j] += d.blocks
+
+    def blocks_uploaded(self):
+        """dict : peer_id -> blocks that peer uploaded over the whole run"""
+        return dict(zip(self.peer_ids, self.uploaded))
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -72,33 +381,33 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        i = self.id_index[peer_id]
+        return AgentHistory(peer_id, self.downloads[peer_id],
+                            self.uploads[peer_id],
+                            (self.ids, self.received[i], self.sent[i]))
 
     def last_round(self):
         """index of the last completed round"""
-        p = self.peer_ids[0]
-        return len(self.downloads[p])-1
+        return self.dl_table.rounds - 1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        lines = ["\nRound %s:\n" % r]
         for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            for d in self.downloads[peer_id][r]:
+                lines.append("%s downloaded %d blocks of piece %d from %s\n" % (
+                    peer_id, d.blocks, d.piece, d.from_id))
+        return "".join(lines)
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        first = self.dl_table.first_round
+        dropped = "(rounds before %d not kept)\n" % first if first > 0 else ""
+        return "History\n" + dropped + "".join(
+            self.pretty_for_round(r) for r in range(first, self.last_round()+1))
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
-
+    pprint.pformat(dict((pid, list(v)) for (pid, v) in self.uploads.items())),
+    pprint.pformat(dict((pid, list(v)) for (pid, v) in self.downloads.items())))
@@ -1,6 +1,19 @@
 #!/usr/bin/python
 
+"""
+The objects agents and the sim pass each other.  A busy round makes tens of
+thousands of Requests, Uploads and Downloads, so they use __slots__: no
+per-instance __dict__, and no attributes beyond the ones listed.
+"""
+
+import itertools
+from array import array
+from types import MappingProxyType
+from collections.abc import Sequence
+
 class Upload:
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -11,6 +24,8 @@ class Upload:
             self.from_id, self.to_id, self.bw)
 
 class Request:
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -21,10 +36,176 @@ class Request:
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
 
+class RequestBatch:
+    """
+    A round's requests from one agent as parallel arrays, instead of a list
+    of Request objects.  requests() can return either; the sim validates
+    and resolves a batch without making a Request per entry, and uploaders
+    only get Requests for the entries they look at (see Inbox).
+
+        batch = RequestBatch(self.id)
+        index = self.swarm.peer_index
+        batch.add(index[peer.id], piece_id, start_block)
+
+    peers: array of the indexes (in swarm.peers) of the peers asked
+    pieces: array of piece ids
+    starts: array of start blocks.  Fractional uploads leave fractional
+        blocks, so it turns into an array of floats if a start is a float.
+
+    >>> batch = RequestBatch("Peer0")
+    >>> batch.add(1, 2, 3)
+    >>> batch.add(1, 4, 2.5)
+    >>> batch.starts
+    array('d', [3.0, 2.5])
+    """
+    __slots__ = ("requester_id", "peers", "pieces", "starts")
+
+    def __init__(self, requester_id, peers=(), pieces=(), starts=()):
+        self.requester_id = requester_id
+        self.peers = array("i", peers)
+        self.pieces = array("i", pieces)
+        try:
+            self.starts = array("i", starts)
+        except TypeError:
+            self.starts = array("d", starts)
+        if not len(self.peers) == len(self.pieces) == len(self.starts):
+            raise ValueError("peers, pieces and starts differ in length")
+
+    def add(self, peer_index, piece_id, start):
+        try:
+            self.starts.append(start)
+        except TypeError:
+            self.starts = array("d", self.starts)
+            self.starts.append(start)
+        self.peers.append(peer_index)
+        self.pieces.append(piece_id)
+
+    def __len__(self):
+        return len(self.peers)
+
+    def requests(self, peer_ids):
+        """The whole batch as a list of Requests"""
+        return [Request(self.requester_id, peer_ids[j], p, s)
+                for (j, p, s) in zip(self.peers, self.pieces, self.starts)]
+
+    def __repr__(self):
+        return "RequestBatch(requester_id=%s, %d requests)" % (
+            self.requester_id, len(self))
+
+class Inbox(Sequence):
+    """
+    The requests sent to a single uploader in one round, in the order they
+    were sent.  Supports len, indexing, iteration, and everything else a
+    tuple does except changes; agents that want a list to change should
+    use list(requests).  Along with the requests, it carries per-requester
+    totals so agents don't have to recompute them:
+
+    inbox.requested_blocks: dict : requester_id -> blocks still needed, summed
+        over all the pieces requested from this uploader
+    inbox.requested_pieces: dict : requester_id -> set(piece ids requested)
+
+    Both the totals and the Request objects are worked out the first time
+    the agent asks for them.  Requests that came in a RequestBatch are kept
+    as entry indexes until then, so an agent that only uses the totals
+    never pays for Request objects.
+    """
+    def __init__(self, peer_id, blocks_per_piece):
+        self.peer_id = peer_id
+        self.blocks_per_piece = blocks_per_piece
+        # [(batch, [its entry indexes])] or [(None, [Request])], in the
+        # order they arrived
+        self.parts = []
+        self.size = 0
+        self.made = None     # list of every Request, once made
+        self.totals = None   # (requested_blocks, requested_pieces), once made
+
+    def add(self, request):
+        if not self.parts or self.parts[-1][0] is not None:
+            self.parts.append((None, []))
+        self.parts[-1][1].append(request)
+        self.size += 1
+        self.made = self.totals = None
+
+    def add_batch(self, batch, entries):
+        """Add these entries of batch, which all ask this peer"""
+        self.parts.append((batch, entries))
+        self.size += len(entries)
+        self.made = self.totals = None
+
+    def requests(self):
+        """All the requests, as a list of Requests"""
+        if self.made is None:
+            made = []
+            add = made.append
+            pid = self.peer_id
+            for (batch, entries) in self.parts:
+                if batch is None:
+                    made.extend(entries)
+                    continue
+                (rid, pieces, starts) = (batch.requester_id, batch.pieces,
+                                         batch.starts)
+                for k in entries:
+                    add(Request(rid, pid, pieces[k], starts[k]))
+            self.made = made
+        return self.made
+
+    def count_totals(self):
+        if self.totals is None:
+            bpp = self.blocks_per_piece
+            blocks = dict()
+            pieces = dict()
+            for (batch, entries) in self.parts:
+                if batch is None:
+                    for r in entries:
+                        rid = r.requester_id
+                        blocks[rid] = blocks.get(rid, 0) + bpp - r.start
+                        pieces.setdefault(rid, set()).add(r.piece_id)
+                else:
+                    # A batch is one requester's
+                    rid = batch.requester_id
+                    (ps, starts) = (batch.pieces, batch.starts)
+                    total = blocks.get(rid, 0)
+                    got = pieces.setdefault(rid, set())
+                    for k in entries:
+                        total += bpp - starts[k]
+                        got.add(ps[k])
+                    blocks[rid] = total
+            self.totals = (blocks, pieces)
+        return self.totals
+
+    @property
+    def requested_blocks(self):
+        return self.count_totals()[0]
+
+    @property
+    def requested_pieces(self):
+        return self.count_totals()[1]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.requests()[i]
+
+    def __iter__(self):
+        return iter(self.requests())
+
+    def requester_ids(self):
+        """Requesters in the order their first request arrived"""
+        return list(self.requested_blocks.keys())
+
+    def distinct_pieces(self, requester_id):
+        return len(self.requested_pieces.get(requester_id, ()))
+
+    def __repr__(self):
+        return "Inbox(%s)" % self.requests()
+
 class Download:
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -36,17 +217,141 @@ class Download:
             self.from_id, self.to_id, self.piece, self.blocks)
 
 
-
-            
 class PeerInfo:
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available_pieces is a PieceSet: a read-only, bitset-backed set of piece
+    ids.  PeerInfos are shared by all agents, so they are read-only too.
     """
+    __slots__ = ("id", "available_pieces")
+
     def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "available_pieces", available)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PeerInfo is read-only")
+
+    def __reduce__(self):
+        return (PeerInfo, (self.id, self.available_pieces))
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+class OtherPeers(Sequence):
+    """
+    The PeerInfos of everyone but one peer: what agents get as their peers
+    argument.  A view on the round's shared tuple of PeerInfos, skipping
+    the agent itself, so making one doesn't copy anything.
+
+    Supports len, indexing, iteration, and everything else a tuple does
+    except changes.  Agents that want to reorder their peers should use
+    sorted(peers, ...) or list(peers).
+    """
+    __slots__ = ("infos", "skip")
+
+    def __init__(self, infos, skip):
+        self.infos = infos    # tuple of PeerInfo
+        self.skip = skip      # index of the peer left out
+
+    def __len__(self):
+        return len(self.infos) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("peer index out of range")
+        return self.infos[i if i < self.skip else i + 1]
+
+    def __iter__(self):
+        infos = self.infos
+        return itertools.chain(itertools.islice(infos, self.skip),
+                               itertools.islice(infos, self.skip + 1, None))
+
+    def __repr__(self):
+        return "OtherPeers(%s)" % list(self)
+
+
+class PiecesView(Sequence):
+    """
+    The blocks a peer has of each piece: what agents get as self.pieces.  A
+    read-only view on the sim's own copy, so handing it out doesn't copy
+    anything, and it keeps up with the sim as blocks arrive.
+
+    Supports len, indexing, iteration, and everything else a tuple does
+    except changes.  Agents that want a copy to keep should use
+    list(self.pieces).
+    """
+    __slots__ = ("blocks",)
+
+    def __init__(self, blocks):
+        self.blocks = blocks   # list, or a read-only memoryview
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.blocks[i])
+        return self.blocks[i]
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __reduce__(self):
+        # Saved as a copy; the sim hands out new views after a restore
+        return (PiecesView, (list(self.blocks),))
+
+    def __repr__(self):
+        return "PiecesView(%s)" % list(self)
+
+
+class SwarmInfo:
+    """
+    Swarm-wide information the sim works out once per round and shares with
+    every agent, as agent.swarm.  Read-only, down to the PieceSets.
+
+    piece_availability: sequence : piece id -> number of peers that have
+        the whole piece (including the agent itself)
+    rarity_groups: ((count, PieceSet), ...) -- the pieces exactly count
+        peers have, rarest first.  Only counts with at least one piece
+        appear.
+    peers: tuple of the PeerInfo of every peer, in peer order
+    peer_index: read-only mapping : peer id -> its index in peers
+    """
+    __slots__ = ("piece_availability", "rarity_groups", "peers",
+                 "peer_index")
+
+    def __init__(self, piece_availability, rarity_groups, peers=(),
+                 peer_index=None):
+        if peer_index is None:
+            peer_index = dict((p.id, i) for (i, p) in enumerate(peers))
+        if not isinstance(peer_index, MappingProxyType):
+            peer_index = MappingProxyType(peer_index)
+        object.__setattr__(self, "piece_availability", piece_availability)
+        object.__setattr__(self, "rarity_groups", tuple(rarity_groups))
+        object.__setattr__(self, "peers", tuple(peers))
+        object.__setattr__(self, "peer_index", peer_index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SwarmInfo is read-only")
+
+    def __reduce__(self):
+        # peer_index can't be pickled; it's rebuilt from peers
+        return (SwarmInfo, (self.piece_availability, self.rarity_groups,
+                            self.peers))
+
+    def others(self, peer_id):
+        """Everyone but peer_id, as an OtherPeers view.  O(1)."""
+        return OtherPeers(self.peers, self.peer_index[peer_id])
+
+    def __repr__(self):
+        return "SwarmInfo(piece_availability=%s)" % (
+            list(self.piece_availability),)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+"""
+Benchmark for the message classes in messages.py.
+
+Makes one round's worth of Requests, Uploads and Downloads for swarms of a
+few sizes, and reports memory per object and time to create one, for the
+slotted classes in messages.py and for the same classes with a per-instance
+__dict__ (what messages.py used before).
+
+A round's worth is, per peer: --requests Requests, --uploads Uploads and
+--downloads Downloads.  The defaults are about what WalziStd sends in the
+middle of a 128 piece run.
+
+    python msgbench.py
+    python msgbench.py --peers 10,50,200,1000 --repeat 5
+"""
+
+import sys
+import gc
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from messages import Upload, Request, Download
+
+
+class DictUpload:
+    def __init__(self, from_id, to_id, up_bw):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.bw = up_bw
+
+
+class DictRequest:
+    def __init__(self, requester_id, peer_id, piece_id, start):
+        self.requester_id = requester_id
+        self.peer_id = peer_id
+        self.piece_id = piece_id
+        self.start = start
+
+
+class DictDownload:
+    def __init__(self, from_id, to_id, piece, blocks):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.piece = piece
+        self.blocks = blocks
+
+
+KINDS = [("Request", Request, DictRequest),
+         ("Upload", Upload, DictUpload),
+         ("Download", Download, DictDownload)]
+
+
+def round_args(kind, ids, per_peer):
+    """The constructor arguments for one round's worth of kind"""
+    n = len(ids)
+    ans = []
+    for (i, pid) in enumerate(ids):
+        for k in range(per_peer):
+            other = ids[(i + k + 1) % n]
+            if kind == "Request":
+                ans.append((pid, other, k, k % 16))
+            elif kind == "Upload":
+                ans.append((pid, other, 12))
+            else:
+                ans.append((other, pid, k, 4))
+    return ans
+
+
+def make_all(cls, args):
+    return [cls(*a) for a in args]
+
+
+def bytes_per_object(cls, args):
+    gc.collect()
+    tracemalloc.start()
+    objs = make_all(cls, args)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # The list holding them is counted too; leave it out
+    size -= sys.getsizeof(objs)
+    return size / float(len(objs))
+
+
+def seconds_per_object(cls, args, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        make_all(cls, args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(args)
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options]"
+    parser = OptionParser(usage=usage_msg)
+    parser.add_option("--peers", dest="peers", default="10,50,200",
+                      help="Comma-separated swarm sizes.  Default 10,50,200")
+    parser.add_option("--requests", dest="requests", type="int", default=60,
+                      help="Requests each peer sends per round")
+    parser.add_option("--uploads", dest="uploads", type="int", default=4,
+                      help="Uploads each peer makes per round")
+    parser.add_option("--downloads", dest="downloads", type="int", default=8,
+                      help="Downloads each peer gets per round")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="Timing runs per case; the fastest counts")
+    (options, args) = parser.parse_args(args)
+
+    per_peer = dict(Request=options.requests, Upload=options.uploads,
+                    Download=options.downloads)
+    print("%6s %-9s %8s %18s %20s %12s" % (
+        "peers", "class", "objects", "bytes/obj (dict)", "ns/obj (dict)",
+        "kB per round"))
+    for n in [int(x) for x in options.peers.split(",")]:
+        ids = ["Peer%d" % i for i in range(n)]
+        for (kind, slotted, plain) in KINDS:
+            args = round_args(kind, ids, per_peer[kind])
+            if not args:
+                continue
+            mem = bytes_per_object(slotted, args)
+            old_mem = bytes_per_object(plain, args)
+            t = seconds_per_object(slotted, args, options.repeat)
+            old_t = seconds_per_object(plain, args, options.repeat)
+            print("%6d %-9s %8d %8.0f (%6.0f) %9.0f (%8.0f) %12.1f" % (
+                n, kind, len(args), mem, old_mem, t * 1e9, old_t * 1e9,
+                mem * len(args) / 1024.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -3,12 +3,26 @@
 import random
 from messages import Upload, Request
 from util import even_split
+from pieceset import PieceSet
 
 class Peer:
+    # The sim only asks a peer for requests while it still needs pieces,
+    # and for uploads in rounds it was sent requests.  Agents that want to
+    # be called anyway, say to update their state every round, list the
+    # calls here: "requests", "uploads" or both.
+    idle_calls = ()
+    # The most rounds back the agent looks: the longest window it passes to
+    # history.received_from() or sent_to(), or how far back it indexes
+    # history.downloads and uploads.  The sim won't run it with a shorter
+    # --history-window.
+    lookback = 1
+
     def __init__(self, config, id, init_pieces, up_bandwidth):
         self.conf = config
         self.id = id
         self.pieces = init_pieces[:]
+        # The sim's SwarmInfo for the current round (see update_swarm)
+        self.swarm = None
         # bandwidth measured in blocks-per-time-period
         self.up_bw = round(up_bandwidth)
 
@@ -31,6 +45,26 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def update_swarm(self, swarm):
+        """
+        Called by the sim at the start of each round with the round's
+        SwarmInfo: piece availability counts and rarity groups, computed
+        once for everyone.
+        """
+        self.swarm = swarm
+
+    def needed_by_rarity(self, needed):
+        """
+        needed: the ids of the pieces this peer still needs
+        returns: those pieces as PieceSets, grouped by how many peers have
+            them, rarest first.  Empty groups are left out.
+        Uses this round's SwarmInfo.  Needed pieces aren't finished, so
+        this peer doesn't count towards their group.
+        """
+        needed = PieceSet(needed)
+        groups = (group & needed for (_, group) in self.swarm.rarity_groups)
+        return [group for group in groups if group]
+
     def requests(self, peers, history):
         return []
 
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+"""
+A compact, read-only set of piece ids, stored as the bits of one python int.
+
+PeerInfo.available_pieces is a PieceSet.  It acts like a frozen set of ints
+(in, len, iteration, comparisons, and &, |, -, ^ with other sets), so
+older agents that call set(peer.available_pieces) keep working.  Agents
+that combine PieceSets with each other get whole-word bit operations
+instead of per-element hashing:
+
+    needed = PieceSet(i for i in range(n) if self.pieces[i] < bpp)
+    isect = peer.available_pieces & needed     # fast
+    len(isect)                                 # popcount
+"""
+
+import operator
+from collections.abc import Set
+
+
+def _popcount(mask):
+    return bin(mask).count("1")
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+
+
+class PieceSet(Set):
+    __slots__ = ("mask",)
+
+    def __init__(self, pieces=()):
+        """pieces: an iterable of non-negative piece ids"""
+        if isinstance(pieces, PieceSet):
+            object.__setattr__(self, "mask", pieces.mask)
+            return
+        ids = list(pieces)
+        if not ids:
+            object.__setattr__(self, "mask", 0)
+            return
+        if min(ids) < 0:
+            raise ValueError("Piece ids must be non-negative")
+        bits = bytearray(max(ids) // 8 + 1)
+        for i in ids:
+            bits[i >> 3] |= 1 << (i & 7)
+        mask = int.from_bytes(bytes(bits), "little")
+        object.__setattr__(self, "mask", mask)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Wrap an existing bit mask: bit i set <=> piece i in the set"""
+        ans = cls.__new__(cls)
+        object.__setattr__(ans, "mask", mask)
+        return ans
+
+    def __setattr__(self, name, value):
+        # Shared by every agent through PeerInfo and SwarmInfo
+        raise AttributeError("PieceSet is read-only")
+
+    def __reduce__(self):
+        return (PieceSet.from_mask, (self.mask,))
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    def with_piece(self, piece_id):
+        """Return a new PieceSet that also contains piece_id"""
+        return PieceSet.from_mask(self.mask | (1 << piece_id))
+
+    def __contains__(self, piece_id):
+        if type(piece_id) is not int:
+            # numpy ints and the like count too, as they do for a set
+            try:
+                piece_id = operator.index(piece_id)
+            except TypeError:
+                return False
+        return piece_id >= 0 and (self.mask >> piece_id) & 1 == 1
+
+    def __len__(self):
+        return _popcount(self.mask)
+
+    def __iter__(self):
+        """Piece ids in increasing order"""
+        m = self.mask
+        while m:
+            low = m & -m
+            yield low.bit_length() - 1
+            m ^= low
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def _mask_of(self, other):
+        """
+        Returns (mask, other): other's bit mask, or None if it holds
+        anything but piece ids, and other as a collection (it may have been
+        a one-shot iterator).  Sets with other things in them are combined
+        the way a frozenset would.
+        """
+        if isinstance(other, PieceSet):
+            return (other.mask, other)
+        if not isinstance(other, Set):
+            other = list(other)
+        try:
+            return (PieceSet(other).mask, other)
+        except (TypeError, ValueError):
+            return (None, other)
+
+    def __and__(self, other):
+        if not isinstance(other, PieceSet):
+            # Cheaper than building a mask from a big plain set
+            return PieceSet(i for i in other if i in self)
+        return PieceSet.from_mask(self.mask & other.mask)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self) | frozenset(other)
+        return PieceSet.from_mask(self.mask | mask)
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self) - frozenset(other)
+        return PieceSet.from_mask(self.mask & ~mask)
+
+    def __rsub__(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(other) - frozenset(self)
+        return PieceSet.from_mask(mask & ~self.mask)
+
+    def __xor__(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self) ^ frozenset(other)
+        return PieceSet.from_mask(self.mask ^ mask)
+
+    __rxor__ = __xor__
+
+    def __eq__(self, other):
+        if isinstance(other, PieceSet):
+            return self.mask == other.mask
+        return Set.__eq__(self, other)
+
+    def __le__(self, other):
+        if isinstance(other, PieceSet):
+            return (self.mask & ~other.mask) == 0
+        return Set.__le__(self, other)
+
+    # Equal to a frozenset with the same pieces, so hash the same way
+    __hash__ = Set._hash
+
+    def isdisjoint(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self).isdisjoint(other)
+        return (self.mask & mask) == 0
+
+    # Same names as the set methods, for agents that use those
+    def intersection(self, other):
+        return self & other
+
+    def union(self, other):
+        return self | other
+
+    def difference(self, other):
+        return self - other
+
+    def issubset(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self).issubset(other)
+        return (self.mask & ~mask) == 0
+
+    def issuperset(self, other):
+        (mask, other) = self._mask_of(other)
+        if mask is None:
+            return frozenset(self).issuperset(other)
+        return (mask & ~self.mask) == 0
+
+    def __repr__(self):
+        return "PieceSet(%s)" % list(self)
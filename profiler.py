@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+"""
+Opt-in profiling for the sim.
+
+PhaseTimer (sim.py --profile) measures wall-clock time spent in each phase
+of every round.  The sim calls mark(phase) at the end of each phase; the
+time since the previous mark is charged to that phase.  When profiling is
+off the sim uses NullTimer, whose methods do nothing.
+
+AgentTimer (sim.py --time-agents) records the CPU time of every call to an
+agent's requests() and uploads(), so slow strategies are easy to spot.
+"""
+
+import time
+import json
+import pstats
+from array import array
+
+from util import mean, percentile
+
+# What write_profile can save
+PROFILE_FORMATS = ["pstats", "collapsed"]
+
+
+class NullTimer:
+    def begin_round(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+
+class PhaseTimer:
+    # The phases of a round, in the order they happen
+    PHASES = ["request collection",
+              "request validation",
+              "inbox building",
+              "upload collection",
+              "transfer resolution",
+              "history update",
+              "logging",
+              "termination check"]
+
+    def __init__(self):
+        self.totals = dict((p, 0.0) for p in self.PHASES)  # phase -> seconds
+        self.worst = dict((p, 0.0) for p in self.PHASES)   # phase -> seconds
+        self.rounds = 0
+        self.last = None
+
+    def begin_round(self):
+        self.rounds += 1
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.totals[phase] += elapsed
+        if elapsed > self.worst[phase]:
+            self.worst[phase] = elapsed
+        self.last = now
+
+    def table(self):
+        """Return the per-phase summary as a printable table"""
+        total = sum(self.totals.values())
+        rounds = max(self.rounds, 1)
+        lines = ["%-20s %10s %12s %12s %7s" % (
+            "phase", "total (s)", "mean (ms)", "max (ms)", "share")]
+        for p in self.PHASES:
+            share = self.totals[p] / total if total > 0 else 0
+            lines.append("%-20s %10.3f %12.3f %12.3f %6.1f%%" % (
+                p, self.totals[p], 1000 * self.totals[p] / rounds,
+                1000 * self.worst[p], 100 * share))
+        lines.append("%-20s %10.3f %12.3f   (%d rounds)" % (
+            "all phases", total, 1000 * total / rounds, self.rounds))
+        return "\n".join(lines)
+
+
+def write_profile(profile, filename, fmt):
+    """
+    Save a cProfile.Profile.  fmt is 'pstats' (readable with pstats or
+    snakeviz) or 'collapsed': one "caller;callee microseconds" line per call
+    edge, which flame graph tools accept.  cProfile only records callers one
+    level up, so the collapsed stacks are two frames deep.
+    """
+    if fmt == "pstats":
+        profile.dump_stats(filename)
+        return
+    if fmt not in PROFILE_FORMATS:
+        raise ValueError("Unknown profile format: %s" % fmt)
+
+    def name(func):
+        (filename, line, funcname) = func
+        return "%s:%d:%s" % (filename, line, funcname)
+
+    stats = pstats.Stats(profile).stats
+    with open(filename, "w") as f:
+        for func in stats:
+            (_, _, inline_time, _, callers) = stats[func]
+            if not callers:
+                f.write("%s %d\n" % (name(func), int(inline_time * 1e6)))
+            for caller in callers:
+                caller_inline_time = callers[caller][2]
+                f.write("%s;%s %d\n" % (name(caller), name(func),
+                                        int(caller_inline_time * 1e6)))
+
+
+class AgentTimer:
+    """
+    CPU time of agent calls, kept per peer and method, plus the total CPU
+    time of the rounds they ran in.
+    """
+    def __init__(self):
+        self.times = dict()        # (peer_id, method) -> array of seconds
+        self.class_of = dict()     # peer_id -> agent class name
+        self.round_time = 0.0
+        self.round_start = None
+
+    def begin_round(self):
+        self.round_start = time.process_time()
+
+    def end_round(self):
+        self.round_time += time.process_time() - self.round_start
+
+    def add(self, peer, method, seconds):
+        key = (peer.id, method)
+        if key not in self.times:
+            self.times[key] = array("d")
+            self.class_of[peer.id] = peer.__class__.__name__
+        self.times[key].append(seconds)
+
+    def describe(self, times):
+        """mean, p95, max, total and share of round time, in seconds"""
+        total = sum(times)
+        return {"calls": len(times),
+                "mean": mean(times),
+                "p95": percentile(times, 95),
+                "max": max(times),
+                "total": total,
+                "share": total / self.round_time if self.round_time > 0 else 0}
+
+    def report(self):
+        """
+        Returns dict with the total round time, and the stats per agent class
+        and per peer id: {"by_class": {name: {method: stats}}, "by_peer": ...}
+        """
+        by_peer = dict()
+        grouped = dict()   # (class name, method) -> [times]
+        for ((peer_id, method), times) in self.times.items():
+            by_peer.setdefault(peer_id, dict())[method] = self.describe(times)
+            grouped.setdefault((self.class_of[peer_id], method),
+                               []).extend(times)
+        by_class = dict()
+        for ((name, method), times) in grouped.items():
+            by_class.setdefault(name, dict())[method] = self.describe(times)
+        return {"round_time": self.round_time,
+                "by_class": by_class,
+                "by_peer": by_peer}
+
+    def table(self):
+        """The report as a printable table, slowest first, times in ms"""
+        r = self.report()
+        lines = ["%-20s %-9s %8s %10s %10s %10s %10s %7s" % (
+            "agent", "method", "calls", "mean", "p95", "max", "total",
+            "share")]
+        def rows(d):
+            entries = [(name, method, d[name][method])
+                       for name in d for method in d[name]]
+            entries.sort(key=lambda e: e[2]["total"], reverse=True)
+            for (name, method, st) in entries:
+                lines.append("%-20s %-9s %8d %10.3f %10.3f %10.3f %10.1f %6.1f%%" % (
+                    name, method, st["calls"], 1000 * st["mean"],
+                    1000 * st["p95"], 1000 * st["max"], 1000 * st["total"],
+                    100 * st["share"]))
+        rows(r["by_class"])
+        lines.append("")
+        rows(r["by_peer"])
+        lines.append("Total round CPU time: %.3f s" % r["round_time"])
+        return "\n".join(lines)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
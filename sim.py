@@ -8,25 +8,63 @@ Simulates one file being shared amongst a set of peers.  The file is divided int
 The simulation proceeds in rounds.  In each round, peers can request pieces from other peers, and then decide how much to upload to others.  Once every peer has every piece, the simulation ends.
 """
 
+import os
 import re
 import random
 import sys
 import logging
-import copy
 import itertools
-import pprint
+import collections
+import multiprocessing
+import cProfile
+import time
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, RequestBatch, Inbox
 from util import *
-from stats import Stats
+from stats import Stats, SummaryStats
 from history import History
+from swarm import make_swarm_state
+from profiler import (PhaseTimer, NullTimer, AgentTimer, write_profile,
+                      PROFILE_FORMATS)
+from archive import ArchiveWriter
+from checkpoint import save_checkpoint, load_checkpoint, check_compatible
+from cache import ResultCache, run_key
     
 
+def make_peer_ids(agent_class_names):
+    """Number the peers of each class in order: Dummy0, Dummy1, Seed0, ..."""
+    counts = dict()
+    def index(name):
+        if name in counts:
+            a = counts[name]
+            counts[name] += 1
+        else:
+            a = 0
+            counts[name] = 1
+        return a
+
+    return ["%s%d" % (n,index(n)) for n in agent_class_names]
+
+
+def run_iteration(job):
+    """Run one iteration in a worker process.  job is (config, seed, i)"""
+    (config, seed, i) = job
+    return Sim(config).run_iteration(seed, i)
+
+
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        if getattr(config, "profile", False):
+            self.timer = PhaseTimer()
+        else:
+            self.timer = NullTimer()
+        if getattr(config, "time_agents", False):
+            self.agent_timer = AgentTimer()
+        else:
+            self.agent_timer = None
 
     
     def up_bw(self, peer_id, reinit=False):
@@ -44,99 +82,69 @@ class Sim:
         
         return s.setdefault(peer_id, the_up_bw)
 
-    def run_sim_once(self):
-        """Return a history"""
+    def run_sim_once(self, archive=None, checkpoint=None, start=None,
+                     resume=False):
+        """
+        Return a history.
+
+        archive: an ArchiveWriter to save every round to, or None.
+        checkpoint: file to save a checkpoint to every
+            config.checkpoint_every rounds and at the end, or None.
+        start: a loaded checkpoint to carry on from instead of starting
+            afresh.  If resume, its random state is restored too, and its
+            archive writer is used.
+        """
         conf = self.config
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = list(map(pred, lst))
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
-
         def check_uploads(peer, uploads):
-            """Raise an IllegalUpload exception if there is a problem."""
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
-
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
-
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-            
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
-
-            limit = self.up_bw(peer.id)
-            if sum([u.bw for u in uploads]) > limit:
+            """Raise an IllegalUpload exception if there is a problem.
+            Everything is checked in a single pass over the uploads."""
+            def bad(msg, u):
+                raise IllegalUpload(msg + " Bad element: %s" % u)
+
+            total = 0
+            for u in uploads:
+                if not isinstance(u, Upload):
+                    bad("List of Uploads contains non-Upload object.", u)
+                if u.to_id == peer.id:
+                    bad("Can't upload to yourself.", u)
+                if u.from_id != peer.id:
+                    bad("Upload.from != peer id.", u)
+                if u.bw < 0:
+                    bad("Upload bandwidth must be non-negative!", u)
+                total += u.bw
+
+            limit = upload_rates[peer.id]
+            if total > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. Attempted to upload %s, for uploads: %s" % (
-                    limit, sum([u.bw for u in uploads])), uploads)
+                    limit, total, uploads))
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
-            """Raise an IllegalRequest exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
-
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-            
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                r.start < 0 or
-                r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
-
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
-            
-            # If we got here, looks ok
-
-        def available_pieces(peer_id, peer_pieces):
+        def peers_to_check():
             """
-            Return a list of piece ids that this peer has available.
+            The peers whose requests and uploads get validated this round.
+            config.validation is 'full' (every round), 'sampled' (every
+            config.validate_every rounds) or 'off'.  Peers of the classes in
+            config.trusted are never validated.
             """
-            return [i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece]
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-            
-        def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+            mode = getattr(conf, "validation", "full")
+            if mode == "off":
+                return frozenset()
+            if mode == "sampled" and round % conf.validate_every != 0:
+                return frozenset()
+            if mode not in ("full", "sampled"):
+                raise ValueError("Unknown validation mode: %s" % mode)
+            return untrusted_ids
+
+        def all_done():
+            # Only the peers that finished since the last check need their
+            # done status recorded.
+            for peer_id in state.take_newly_done():
+                history.peer_is_done(round, peer_id)
+            return state.all_done()
 
         def create_peers():
             """Each agent class must be already loaded, and have a
@@ -147,18 +155,7 @@ class Sim:
                 agent_class = conf.agent_classes[class_name]
                 return agent_class(*params)
 
-            counts = dict()
-            def index(name):
-                if name in counts:
-                    a = counts[name]
-                    counts[name] += 1
-                else:
-                    a = 0
-                    counts[name] = 1
-                return a
-
-            n = len(conf.agent_class_names)
-            ids = ["%s%d" % (n,index(n)) for n in conf.agent_class_names]
+            ids = make_peer_ids(conf.agent_class_names)
 
             is_seed = lambda id: id.startswith("Seed")
 
@@ -182,211 +179,496 @@ class Sim:
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
             return peers, peer_pieces
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
-            p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+        def wake(p):
+            """Get p ready for its first call this round"""
+            if p.id in others:
+                return
+            if p.id in stale:
+                # Hand the peer a read-only view of its pieces, so that it
+                # can't change the simulation's copy.  Peers whose pieces
+                # didn't change since they were last called keep the view
+                # they already have.
+                p.update_pieces(state.pieces_of(p.id))
+                stale.discard(p.id)
+            p.update_swarm(swarm_info)
+            others[p.id] = swarm_info.others(p.id)
+            h[p.id] = history.peer_history(p.id)
+
+        def get_peer_requests(p, others, peer_history):
+            if agent_timer is None:
+                return p.requests(others, peer_history)
+            start = time.process_time()
+            rs = p.requests(others, peer_history)
+            agent_timer.add(p, "requests", time.process_time() - start)
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in list(all_requests.values()):
-                    ans.extend(list(filter(f, rs)))
-                return ans
-
-            requests = requests_to(p.id)
-
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
-            return us
-
-        def upload_rate(uploads, uploader_id, requester_id):
-            """
-            return the uploading rate from uploader to requester
-            in blocks per time period, or 0 if not uploading.
+        def build_inboxes(all_requests):
             """
-            for u in uploads[uploader_id]:
-                if u.to_id == requester_id:
-                    return u.bw
-            return 0
-
-        def update_peer_pieces(peer_pieces, requests, uploads, available):
+            Bucket this round's requests by the peer they were sent to, in one
+            pass.  Returns dict : peer_id -> Inbox, for the peers that were
+            sent any.
             """
-            Process the uploads: figure out how many blocks of all the requested
-            pieces the requesters ended up with.
-            Make sure requesting the same thing from lots of peers doesn't
-            stack.
-            update the sets of available pieces as needed.
-            """
-            downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
-            for requester_id in requests:
-                downloads[requester_id] = list()
-            for requester_id in requests:
-                # Keep track of how many blocks of each piece this
-                # requester got.  piece -> (blocks, from_who)
-                new_blocks_per_piece = dict()
-                def update_count(piece_id, blocks, peer_id):
-                    if piece_id in new_blocks_per_piece:
-                        old = new_blocks_per_piece[piece_id][0]
-                        if blocks > old:
-                            new_blocks_per_piece[piece_id] = (blocks, peer_id)
-                    else:
-                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
-
-                # Group the requests by peer that is being asked
-                get_peer_id = lambda r: r.peer_id
-                rs = sorted(requests[requester_id], key=get_peer_id)
-                for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
-                    bw = upload_rate(uploads, peer_id, requester_id)
-                    if bw == 0:
-                        continue
-                    # This bandwidth gets applied in order to each piece requested
-                    for r in rs_for_peer:
-                        needed_blocks = conf.blocks_per_piece - r.start
-                        alloced_bw = min(bw, needed_blocks)
-                        update_count(r.piece_id, alloced_bw, peer_id)
-                        bw -= alloced_bw
-                        if bw == 0:
-                            break
-                for piece_id in new_blocks_per_piece:
-                    (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
-                    d = Download(peer_id, requester_id, piece_id, blocks)
-                    downloads[requester_id].append(d)
-                
-            return (new_pp, downloads)
-
-        def completed_pieces(peer_id, available):
-            return len(available[peer_id])
-        
-        def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
-
-        peers, peer_pieces = create_peers()
-        self.peer_ids = [p.id for p in peers]
-        self.peers_by_id = dict((p.id, p) for p in peers)
-        
-        upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
+            inboxes = dict()
+            peer_ids = self.peer_ids
+            for rs in all_requests.values():
+                if isinstance(rs, RequestBatch):
+                    # Handed over by entry index, so no Requests are made
+                    # unless the uploader looks at them
+                    by_peer = dict()
+                    for (k, j) in enumerate(rs.peers):
+                        by_peer.setdefault(j, []).append(k)
+                    for (j, entries) in by_peer.items():
+                        inbox = inboxes.get(peer_ids[j])
+                        if inbox is None:
+                            inbox = Inbox(peer_ids[j], conf.blocks_per_piece)
+                            inboxes[peer_ids[j]] = inbox
+                        inbox.add_batch(rs, entries)
+                    continue
+                for r in rs:
+                    inbox = inboxes.get(r.peer_id)
+                    if inbox is None:
+                        inbox = Inbox(r.peer_id, conf.blocks_per_piece)
+                        inboxes[r.peer_id] = inbox
+                    inbox.add(r)
+            return inboxes
+
+        def get_peer_uploads(inbox, p, others, peer_history, check):
+            if agent_timer is None:
+                us = p.uploads(inbox, others, peer_history)
+            else:
+                start = time.process_time()
+                us = p.uploads(inbox, others, peer_history)
+                agent_timer.add(p, "uploads", time.process_time() - start)
+            if check:
+                check_uploads(p, us)
+            return us
 
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        def log_peer_info():
+            if debug:
+                for p_id in self.peer_ids:
+                    pieces = state.pieces_of(p_id)
+                    logging.debug("pieces for %s: %s" % (str(p_id), list(pieces)))
+            if info:
+                log = ", ".join("%s:%s" % (p_id, state.completed_pieces(p_id))
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: " + log)
+
+
+        # Only build log messages that are going to be shown.  On big runs,
+        # formatting the per-round messages costs more than the sim itself.
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        info = logging.getLogger().isEnabledFor(logging.INFO)
+
+        logging.debug("Starting simulation with config: %s", conf)
+
+        if start is None:
+            peers, peer_pieces = create_peers()
+            self.peer_ids = [p.id for p in peers]
+
+            # Looked up when validating uploads, so the limit isn't recomputed
+            upload_rates = dict((id, self.up_bws_state[id])
+                                for id in self.peer_ids)
+            history = History(self.peer_ids, upload_rates,
+                              getattr(conf, "history_window", None))
+
+            state = make_swarm_state(conf, self.peer_ids, peer_pieces)
+            if archive is not None:
+                archive.begin(self.peer_ids, upload_rates)
+
+            # Peers whose piece snapshot needs refreshing before they're
+            # next called
+            stale = set(self.peer_ids)
+            ended = False
+        else:
+            logging.info("%s from the checkpoint at round %d",
+                         "Resuming" if resume else "Warm-starting",
+                         start["round"])
+            round = start["round"]
+            peers = start["peers"]
+            self.peer_ids = [p.id for p in peers]
+            self.up_bws_state = start["up_bws_state"]
+            history = start["history"]
+            upload_rates = history.upload_rates
+            state = start["state"]
+            # The peers' piece views were saved as copies, so they all
+            # need new ones
+            stale = set(self.peer_ids)
+            # A warm start carries on past the end of the run that saved
+            # it, unless there's nothing left to do
+            ended = start["ended"] if resume else state.all_done()
+            if not ended and round > conf.max_round:
+                # Saved at the end of a run that ran out of time, or after
+                # this run's --max-round
+                logging.warning("Checkpoint is at round %d, past the"
+                                " limit of %d rounds: nothing to run" % (
+                                    round, conf.max_round))
+                ended = True
+            if resume:
+                random.setstate(start["random"])
+        start_round = round
+
+        trusted = set(getattr(conf, "trusted", ()))
+        untrusted_ids = frozenset(p.id for p in peers
+                                  if p.__class__.__name__ not in trusted)
+
+        def save_checkpoint_now():
+            save_checkpoint(checkpoint, {
+                "config": dict((k, getattr(conf, k)) for k in
+                               ("agent_class_names", "num_pieces",
+                                "blocks_per_piece", "engine")),
+                "round": round,
+                "ended": ended,
+                "peers": peers,
+                "up_bws_state": self.up_bws_state,
+                "history": history,
+                "state": state,
+                "random": random.getstate(),
+                "archive": archive})
+            logging.info("Saved checkpoint at round %d", round)
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
+        timer = self.timer
+        agent_timer = self.agent_timer
+        checkpoint_every = getattr(conf, "checkpoint_every", 100)
+        while not ended:
+            if (checkpoint is not None and round != start_round and
+                    round % checkpoint_every == 0):
+                save_checkpoint_now()
+
+            logging.info("======= Round %d ========", round)
+            timer.begin_round()
+            if agent_timer is not None:
+                agent_timer.begin_round()
+
+            # One read-only snapshot of the swarm per round.  Each agent gets
+            # a view of it that leaves the agent out; nothing is copied.
+            swarm_info = state.swarm_info()
+            others = dict()    # peer_id -> OtherPeers, for peers called
+            h = dict()         # peer_id -> AgentHistory, for peers called
+            requests = dict()  # peer_id -> list of Requests, or RequestBatch
             uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
 
+            # Only peers that still need pieces are asked for requests, and
+            # only peers that were sent requests are asked for uploads,
+            # unless their class wants idle calls too (Peer.idle_calls).
+            done = state.done
             for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-                
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
+                if p.id not in done or "requests" in p.idle_calls:
+                    wake(p)
+                    requests[p.id] = get_peer_requests(p, others[p.id],
+                                                       h[p.id])
+            timer.mark("request collection")
+            check_ids = peers_to_check()
+            checked_requests = state.check_requests(requests, check_ids)
+            timer.mark("request validation")
+
+            inboxes = build_inboxes(requests)
+            timer.mark("inbox building")
+            for p in peers:
+                inbox = inboxes.get(p.id)
+                if inbox is None:
+                    if "uploads" not in p.idle_calls:
+                        uploads[p.id] = []
+                        continue
+                    inbox = Inbox(p.id, conf.blocks_per_piece)
+                wake(p)
+                uploads[p.id] = get_peer_uploads(inbox, p, others[p.id],
+                                                 h[p.id], p.id in check_ids)
+            timer.mark("upload collection")
+
+            (changed, downloads) = state.apply_transfers(checked_requests,
+                                                         uploads)
+            stale |= changed
+            timer.mark("transfer resolution")
             history.update(downloads, uploads)
-
-            logging.debug(history.pretty_for_round(round))
-
-            log_peer_info(peer_pieces, available)
-           
-            if all_done(peer_pieces):
-                logging.info("All done!")                    
+            if archive is not None:
+                archive.write_round(downloads, uploads)
+            timer.mark("history update")
+
+            if debug:
+                logging.debug(history.pretty_for_round(round))
+
+            log_peer_info()
+            timer.mark("logging")
+
+            finished = all_done()
+            timer.mark("termination check")
+            if agent_timer is not None:
+                agent_timer.end_round()
+            if finished:
+                logging.info("All done!")
                 break
             round += 1
             if round > conf.max_round:
                 logging.info("Out of time.  Stopping.")
                 break
-
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+        ended = True
+        if checkpoint is not None:
+            # Resuming from here just returns the history
+            save_checkpoint_now()
+
+        if info:
+            logging.info("Game history:\n%s" % history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s" %
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s" %
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s" %
+                         Stats.all_done_round(self.peer_ids, history))
 
         return history
 
-    def run_sim(self):
-        histories = [self.run_sim_once() for i in range(self.config.iters)]
-        logging.warning("======== SUMMARY STATS ========")
-        
-        uploaded_blocks = [Stats.uploaded_blocks(self.peer_ids, h) for h in histories]
-        completion_rounds = [Stats.completion_rounds(self.peer_ids, h) for h in histories]
-
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return [d[peer_id] for d in lst]
+    def run_iteration(self, seed, i=0):
+        """
+        Run one seeded iteration, the i'th, and return just its
+        Stats.summary.  Saves it to an archive if config.archive is set,
+        and checkpoints it if config.checkpoint is.  With config.resume, an
+        iteration that already has a checkpoint carries on from it;
+        otherwise config.warm_start is the checkpoint to start from.
+        With config.cache, a result already in the cache is returned as
+        is.
+        """
+        conf = self.config
+        cache = self.result_cache()
+        if cache is not None:
+            key = run_key(conf, seed)
+            summary = cache.get(key)
+            if summary is not None:
+                logging.info("Iteration %d: using the cached result", i)
+                return summary
+        random.seed(seed)
+        checkpoint = None
+        if getattr(conf, "checkpoint", None):
+            checkpoint = iteration_path(conf.checkpoint, i, self.max_iters())
+        start = None
+        resume = False
+        if (getattr(conf, "resume", False) and checkpoint is not None and
+                os.path.exists(checkpoint)):
+            start = load_checkpoint(checkpoint)
+            resume = True
+        elif getattr(conf, "warm_start", None):
+            start = load_checkpoint(conf.warm_start)
+        if start is not None:
+            check_compatible(start, conf)
+
+        archive = None
+        if resume:
+            # Carry on with the archive the checkpoint was writing, if any
+            archive = start["archive"]
+            if archive is not None:
+                archive.reopen()
+        elif getattr(conf, "archive", None):
+            if start is not None:
+                raise ValueError("Can't archive a warm-started run: the"
+                                 " archive would be missing its first rounds")
+            path = iteration_path(conf.archive, i, self.max_iters())
+            archive = ArchiveWriter(path, conf, {"seed": seed, "iteration": i,
+                                                 "hash_seed": hash_seed()})
+        try:
+            history = self.run_sim_once(archive, checkpoint, start, resume)
+        except BaseException:
+            if archive is not None:
+                archive.abort()
+            raise
+        if archive is not None:
+            archive.finish(history.round_done)
+        summary = Stats.summary(self.peer_ids, history)
+        if cache is not None:
+            cache.put(key, summary, conf.agent_class_names)
+        return summary
+
+    def result_cache(self):
+        """The ResultCache for config.cache, or None if not caching"""
+        conf = self.config
+        if not getattr(conf, "cache", None):
+            return None
+        # Runs that leave files behind, or are there to be measured, have
+        # to actually run, and so do runs the seed alone can't reproduce
+        if (any(getattr(conf, k, None) for k in
+                ("archive", "checkpoint", "warm_start", "profile")) or
+                self.agent_timer is not None or hash_seed() is None):
+            return None
+        size = getattr(conf, "cache_size", None)
+        return ResultCache(conf.cache,
+                           None if size is None else int(size * 1048576))
+
+    def max_iters(self):
+        """How many iterations to run: --iters, or the cap with --ci-width"""
+        conf = self.config
+        if getattr(conf, "ci_width", None) is None:
+            return conf.iters
+        return conf.max_iters
+
+    def enough_iterations(self, stats):
+        """
+        With --ci-width, whether the confidence intervals on the per-class
+        means are narrow enough to stop.  Logs how far along they are.
+        """
+        conf = self.config
+        target = getattr(conf, "ci_width", None)
+        if target is None:
+            return False
+        worst = stats.widest_interval()
+        if worst is None:
+            return True
+        (name, stat, width) = worst
+        logging.warning("Iteration %d: widest interval is %s %s, %s of the"
+                        " mean (target %.1f%%)" % (
+                            stats.iterations, name, stat,
+                            "%.1f%%" % (100 * width) if width < float("inf")
+                            else "unknown", 100 * target))
+        return stats.iterations >= conf.min_iters and width <= target
+
+    def run_iterations(self):
+        """
+        Run config.iters iterations, in parallel if config.workers > 1.
+        With config.ci_width set, keep going instead until the confidence
+        intervals on the per-class means are that narrow, or until
+        config.max_iters.
+
+        Returns a SummaryStats with every iteration's Stats.summary folded
+        in as it finished.
+        """
+        conf = self.config
+        base_seed = getattr(conf, "seed", None)
+        if base_seed is None:
+            base_seed = random.randrange(2**31)
+        # Logged with the results, so every run can be repeated
+        if hash_seed() is None:
+            logging.warning("Base seed: %d.  PYTHONHASHSEED isn't set, so"
+                            " the seed alone may not reproduce this run"
+                            % base_seed)
+        else:
+            logging.warning("Base seed: %d, PYTHONHASHSEED=%s" % (
+                base_seed, hash_seed()))
+        # Every iteration gets its own seed, so results don't depend on how
+        # the iterations are spread across workers.
+        jobs = ((conf, derive_seed(base_seed, i), i)
+                for i in range(self.max_iters()))
+
+        workers = getattr(conf, "workers", 1)
+        if workers > 1 and (getattr(conf, "profile", False) or
+                            self.agent_timer is not None):
+            logging.warning("Profiling: running iterations in this process"
+                            " instead of %d workers" % workers)
+            workers = 1
+        self.peer_ids = make_peer_ids(conf.agent_class_names)
+        stats = SummaryStats(self.peer_ids, conf.agent_class_names)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            # Keep a few iterations queued per worker.  When to stop is
+            # decided after each iteration in order, so it doesn't depend
+            # on the number of workers; the ones still running then are
+            # thrown away.
+            if getattr(conf, "ci_width", None) is None:
+                ahead = self.max_iters()
+            else:
+                ahead = 2 * workers
+            pending = collections.deque()
+            try:
+                for job in itertools.islice(jobs, ahead):
+                    pending.append(pool.apply_async(run_iteration, (job,)))
+                while pending:
+                    # In order, so the floating point sums don't depend on
+                    # which worker finishes first
+                    stats.add(pending.popleft().get())
+                    if self.enough_iterations(stats):
+                        break
+                    for job in itertools.islice(jobs, 1):
+                        pending.append(pool.apply_async(run_iteration,
+                                                        (job,)))
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for (_, seed, i) in jobs:
+                stats.add(self.run_iteration(seed, i))
+                if self.enough_iterations(stats):
+                    break
+        return stats
 
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
+    def run_sim(self):
+        conf = self.config
+        profile_out = getattr(conf, "profile_out", None)
+        if profile_out:
+            profile = cProfile.Profile()
+            profile.enable()
+        summary = self.run_iterations()
+        stats = summary.result()
+        if profile_out:
+            profile.disable()
+            write_profile(profile, profile_out, conf.profile_format)
 
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
-            for p_id in self.peer_ids)
+        logging.warning("======== SUMMARY STATS ========")
 
         logging.warning("Uploaded blocks: avg (stddev)")
         for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
-            us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+                           key=lambda id: stats[id]["uploaded_mean"]):
+            st = stats[p_id]
+            logging.warning("%s: %.1f  (%.1f)" % (
+                p_id, st["uploaded_mean"], st["uploaded_stddev"]))
 
-        logging.warning("Completion rounds: avg (stddev)")
-
-        def optionize(f):
-            def g(lst):
-                if None in lst:
-                    return None
-                else:
-                    return f(lst)
-            return g
-
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
-        
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
-            cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+        # Peers that didn't finish every iteration go last
+        def by_completion(key):
+            return lambda id: (stats[id][key] is None, stats[id][key] or 0)
 
+        logging.warning("Completion rounds: avg (stddev)")
+        for p_id in sorted(self.peer_ids, key=by_completion("completion_mean")):
+            st = stats[p_id]
+            logging.warning("%s: %s  (%s)" % (
+                p_id, st["completion_mean"], st["completion_stddev"]))
+
+        logging.warning("Completion rounds: p50, p95  (iterations finished)")
+        for p_id in sorted(self.peer_ids, key=by_completion("completion_p50")):
+            st = stats[p_id]
+            logging.warning("%s: %s, %s  (%d/%d)" % (
+                p_id, st["completion_p50"], st["completion_p95"],
+                st["finished"], summary.iterations))
+
+        if getattr(conf, "ci_width", None) is not None:
+            self.log_intervals(summary)
+
+        if self.agent_timer is not None:
+            logging.warning("Agent CPU time (ms): calls, mean, p95, max, total,"
+                            " share of round time")
+            logging.warning(self.agent_timer.table())
+            agent_times_out = getattr(conf, "agent_times_out", None)
+            if agent_times_out:
+                self.agent_timer.write(agent_times_out)
+
+        if getattr(conf, "profile", False):
+            logging.warning("======== PROFILE ========")
+            logging.warning(self.timer.table())
+
+
+    def log_intervals(self, summary):
+        conf = self.config
+        worst = summary.widest_interval()
+        if worst is None or worst[2] <= conf.ci_width:
+            logging.warning("Confidence intervals within %.1f%% after %d"
+                            " iterations" % (100 * conf.ci_width,
+                                             summary.iterations))
+        else:
+            logging.warning("Stopped at --max-iters %d before the confidence"
+                            " intervals got within %.1f%%" % (
+                                summary.iterations, 100 * conf.ci_width))
+
+        def interval(mean, half):
+            if mean is None:
+                return "None"
+            if half is None:
+                return "%.2f" % mean
+            return "%.2f +/- %.2f" % (mean, half)
+
+        intervals = summary.intervals()
+        logging.warning("Per class means, 95% confidence: completion round;"
+                        " uploaded blocks")
+        for name in sorted(intervals):
+            logging.warning("%s: %s; %s" % (
+                name, interval(*intervals[name]["completion"]),
+                interval(*intervals[name]["uploaded"])))
 
 
 def configure_logging(loglevel):
@@ -423,6 +705,66 @@ def parse_agents(args):
             
         
 
+def min_history_window(agent_classes):
+    """
+    The shortest history window the agents can run with: the furthest back
+    any of them looks (Peer.lookback).
+
+    >>> min_history_window(load_modules(["Seed", "WalziTyrant", "WalziStd"]))
+    20
+    """
+    return max(c.lookback for c in agent_classes.values())
+
+
+def make_config(agents_to_run, num_pieces=3, blocks_per_piece=4, max_round=5,
+                min_up_bw=4, max_up_bw=10, iters=1, engine="lists", workers=1,
+                seed=None, validation="full", validate_every=10, trusted=(),
+                profile=False, profile_out=None, profile_format="pstats",
+                time_agents=False, agent_times_out=None, history_window=None,
+                archive=None, checkpoint=None, checkpoint_every=100,
+                resume=False, warm_start=None, ci_width=None, min_iters=5,
+                max_iters=100, cache=None, cache_size=100):
+    """
+    Build the Params for a run.  agents_to_run is a list of class names, one
+    per peer, as returned by parse_agents.  The defaults match the command
+    line defaults.
+    """
+    config = Params()
+
+    config.add("agent_class_names", agents_to_run)
+    config.add("agent_classes", load_modules(config.agent_class_names))
+
+    config.add("num_pieces", num_pieces)
+    config.add("blocks_per_piece", blocks_per_piece)
+    config.add("max_round", max_round)
+    config.add("min_up_bw", min_up_bw)
+    config.add("max_up_bw", max_up_bw)
+    config.add("iters", iters)
+    config.add("engine", engine)
+    config.add("workers", workers)
+    config.add("seed", seed)
+    config.add("validation", validation)
+    config.add("validate_every", validate_every)
+    config.add("trusted", list(trusted))
+    config.add("profile", profile)
+    config.add("profile_out", profile_out)
+    config.add("profile_format", profile_format)
+    config.add("time_agents", time_agents)
+    config.add("agent_times_out", agent_times_out)
+    config.add("history_window", history_window)
+    config.add("archive", archive)
+    config.add("checkpoint", checkpoint)
+    config.add("checkpoint_every", checkpoint_every)
+    config.add("resume", resume)
+    config.add("warm_start", warm_start)
+    config.add("ci_width", ci_width)
+    config.add("min_iters", min_iters)
+    config.add("max_iters", max_iters)
+    config.add("cache", cache)
+    config.add("cache_size", cache_size)
+    return config
+
+
 def main(args):
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
     parser = OptionParser(usage=usage_msg)
@@ -436,6 +778,11 @@ def main(args):
                       dest="loglevel", default="info",
                       help="Set the logging level: 'debug' or 'info'")
 
+    parser.add_option("--quiet",
+                      dest="quiet", default=False, action="store_true",
+                      help="Only log the summary stats.  Same as"
+                      " --loglevel warning; per-round messages are never built")
+
     parser.add_option("--num-pieces",
                       dest="num_pieces", default=3, type="int",
                       help="Set number of pieces in the file")
@@ -461,6 +808,123 @@ def main(args):
                       help="Number of times to run simulation to get stats")
 
 
+    parser.add_option("--engine",
+                      dest="engine", default="lists",
+                      help="How to store the swarm state: 'lists' or 'numpy'"
+                      " (vectorized, for big swarms; needs numpy)")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to spread iterations across")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Base random seed.  Each iteration gets a seed"
+                      " derived from it (default: pick one at random)."
+                      "  Runs are only repeatable with PYTHONHASHSEED set"
+                      " too")
+
+    parser.add_option("--validation",
+                      dest="validation", default="full",
+                      help="Check agents' requests and uploads: 'full' (every"
+                      " round), 'sampled' (every --validate-every rounds) or"
+                      " 'off'")
+
+    parser.add_option("--validate-every",
+                      dest="validate_every", default=10, type="int",
+                      help="How often to validate in 'sampled' mode")
+
+    parser.add_option("--trusted",
+                      dest="trusted", default="",
+                      help="Comma-separated agent classes that are never"
+                      " validated, e.g. WalziStd,WalziTyrant")
+
+    parser.add_option("--profile",
+                      dest="profile", default=False, action="store_true",
+                      help="Time each phase of every round and print a summary"
+                      " table at the end")
+
+    parser.add_option("--profile-out",
+                      dest="profile_out", default=None,
+                      help="Also run under cProfile and save the profile to"
+                      " this file (implies --profile)")
+
+    parser.add_option("--profile-format",
+                      dest="profile_format", default="pstats",
+                      help="Format for --profile-out: 'pstats' or 'collapsed'"
+                      " (caller;callee stacks for flame graphs)")
+
+    parser.add_option("--time-agents",
+                      dest="time_agents", default=False, action="store_true",
+                      help="Time every agent requests() and uploads() call and"
+                      " report CPU time per agent class and peer")
+
+    parser.add_option("--agent-times-out",
+                      dest="agent_times_out", default=None,
+                      help="Also write the agent timings to this file as JSON"
+                      " (implies --time-agents)")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Only keep the last N rounds of downloads and uploads"
+                      " in memory.  Agents can't look further back, so N must"
+                      " cover their lookback.  Default: keep them all")
+
+    parser.add_option("--archive",
+                      dest="archive", default=None,
+                      help="Save every round to this file in binary, for"
+                      " analysis with archive.py.  With --iters N, iteration"
+                      " i goes to FILE.i.ext instead")
+
+    parser.add_option("--checkpoint",
+                      dest="checkpoint", default=None,
+                      help="Save the whole sim state to this file every"
+                      " --checkpoint-every rounds and at the end.  With"
+                      " --iters N, iteration i uses FILE.i.ext instead")
+
+    parser.add_option("--checkpoint-every",
+                      dest="checkpoint_every", default=100, type="int",
+                      help="Rounds between checkpoints")
+
+    parser.add_option("--resume",
+                      dest="resume", default=False, action="store_true",
+                      help="Carry on from the --checkpoint file(s) where they"
+                      " exist, exactly as the interrupted run would have")
+
+    parser.add_option("--warm-start",
+                      dest="warm_start", default=None,
+                      help="Start every iteration from this checkpoint instead"
+                      " of from round 0, each with its own seed")
+
+    parser.add_option("--ci-width",
+                      dest="ci_width", default=None, type="float",
+                      help="Instead of a fixed --iters, run iterations until"
+                      " the 95% confidence intervals on each agent class's"
+                      " mean completion round and uploaded blocks are"
+                      " narrower than this fraction of the mean, e.g. 0.05")
+
+    parser.add_option("--min-iters",
+                      dest="min_iters", default=5, type="int",
+                      help="With --ci-width, run at least this many"
+                      " iterations")
+
+    parser.add_option("--max-iters",
+                      dest="max_iters", default=100, type="int",
+                      help="With --ci-width, stop after this many iterations"
+                      " even if the intervals are still wider")
+
+    parser.add_option("--cache",
+                      dest="cache", default=None,
+                      help="Look up each iteration's result in this cache"
+                      " directory before running it, and save it there after"
+                      " (see cache.py).  Only used with a fixed"
+                      " PYTHONHASHSEED")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=100, type="float",
+                      help="Keep the --cache under this many megabytes,"
+                      " dropping the least recently used results")
+
     (options, args) = parser.parse_args()
 
     # leftover args are class names, with optional counts:
@@ -475,26 +939,65 @@ def main(args):
         except ValueError as e:
             usage(e)
     
-    configure_logging(options.loglevel)
-    config = Params()
+    if options.history_window is not None and options.history_window < 1:
+        usage("--history-window must be at least 1")
+    if options.validate_every < 1:
+        usage("--validate-every must be at least 1")
+    if options.checkpoint_every < 1:
+        usage("--checkpoint-every must be at least 1")
+    if options.resume and not options.checkpoint:
+        usage("--resume needs --checkpoint")
+    if options.ci_width is not None and options.ci_width <= 0:
+        usage("--ci-width must be positive")
+    if options.min_iters < 2:
+        usage("--min-iters must be at least 2")
+    if options.max_iters < options.min_iters:
+        usage("--max-iters must be at least --min-iters")
+    if options.cache_size <= 0:
+        usage("--cache-size must be positive")
+    if options.profile_format not in PROFILE_FORMATS:
+        usage("Unknown profile format: %s" % options.profile_format)
+
+    configure_logging("warning" if options.quiet else options.loglevel)
+    config = make_config(agents_to_run,
+                         num_pieces=options.num_pieces,
+                         blocks_per_piece=options.blocks_per_piece,
+                         max_round=options.max_round,
+                         min_up_bw=options.min_up_bw,
+                         max_up_bw=options.max_up_bw,
+                         iters=options.iters,
+                         engine=options.engine,
+                         workers=options.workers,
+                         seed=options.seed,
+                         validation=options.validation,
+                         validate_every=options.validate_every,
+                         trusted=[c for c in options.trusted.split(",") if c],
+                         profile=options.profile or bool(options.profile_out),
+                         profile_out=options.profile_out,
+                         profile_format=options.profile_format,
+                         time_agents=(options.time_agents or
+                                      bool(options.agent_times_out)),
+                         agent_times_out=options.agent_times_out,
+                         history_window=options.history_window,
+                         archive=options.archive,
+                         checkpoint=options.checkpoint,
+                         checkpoint_every=options.checkpoint_every,
+                         resume=options.resume,
+                         warm_start=options.warm_start,
+                         ci_width=options.ci_width,
+                         min_iters=options.min_iters,
+                         max_iters=options.max_iters,
+                         cache=options.cache,
+                         cache_size=options.cache_size)
+
+    if options.history_window is not None:
+        lookback = min_history_window(config.agent_classes)
+        if options.history_window < lookback:
+            usage("--history-window must be at least %d: the agents look"
+                  " back that many rounds" % lookback)
 
-    config.add("agent_class_names", agents_to_run)
-    config.add("agent_classes", load_modules(config.agent_class_names))
-
-    
-    config.add("num_pieces", options.num_pieces)
-    config.add("blocks_per_piece",options.blocks_per_piece)
-    config.add("max_round", options.max_round)
-    config.add("min_up_bw", options.min_up_bw)
-    config.add("max_up_bw", options.max_up_bw)
-    config.add("iters", options.iters)
-    
     sim = Sim(config)
     sim.run_sim()
 
 if __name__ == "__main__":
-
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+    main(sys.argv)
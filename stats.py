@@ -1,5 +1,225 @@
 #!/usr/bin/python
 
+import math
+
+# Two-sided 95% quantiles of Student's t, by degrees of freedom
+T_95 = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+        2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+        2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+        2.042]
+
+
+def t_95(df):
+    if df < len(T_95):
+        return T_95[df]
+    # Within 0.002 of the real thing from 30 up
+    return 1.960 + 2.4 / df
+
+
+class RunningStats:
+    """
+    Count, mean and (population) standard deviation of a stream of numbers,
+    without keeping them: Welford's update, plus Chan et al.'s rule to merge
+    two of these, e.g. from different worker processes.
+    """
+    def __init__(self):
+        self.n = 0
+        self.total = 0      # The mean is reported as total / n
+        self.avg = 0.0      # Welford's running mean
+        self.m2 = 0.0       # Sum of squared differences from the mean
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        delta = x - self.avg
+        self.avg += delta / self.n
+        self.m2 += delta * (x - self.avg)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.avg - self.avg
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.avg += delta * other.n / n
+        self.total += other.total
+        self.n = n
+
+    def mean(self):
+        """None if nothing was added"""
+        return self.total / float(self.n) if self.n else None
+
+    def stddev(self):
+        return math.sqrt(self.m2 / self.n) if self.n else None
+
+    def half_width(self):
+        """
+        Half the width of the 95% confidence interval on the mean, treating
+        the numbers as independent samples.  None for fewer than 2.
+        """
+        if self.n < 2:
+            return None
+        return t_95(self.n - 1) * math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantiles of a stream of integers, such as completion rounds.
+    Keeps a count per distinct value, so it's exact, and small as long as
+    the values are bounded (completion rounds are at most max_round).
+    """
+    def __init__(self):
+        self.counts = dict()   # value -> times seen
+        self.n = 0
+
+    def add(self, x):
+        self.counts[x] = self.counts.get(x, 0) + 1
+        self.n += 1
+
+    def merge(self, other):
+        for (x, c) in other.counts.items():
+            self.counts[x] = self.counts.get(x, 0) + c
+        self.n += other.n
+
+    def quantile(self, p):
+        """
+        Nearest-rank, like util.percentile: the smallest value with at least
+        p percent of the values at or below it.  None if nothing was added.
+        """
+        if self.n == 0:
+            return None
+        rank = max(int(math.ceil(p / 100.0 * self.n)), 1)
+        seen = 0
+        for x in sorted(self.counts):
+            seen += self.counts[x]
+            if seen >= rank:
+                return x
+
+
+class SummaryStats:
+    """
+    Per-peer statistics over many iterations, folded in one Stats.summary at
+    a time, so nothing from finished iterations has to be kept around.
+
+    Given the agent class of each peer, it also keeps, per class, the
+    class's mean uploaded blocks and mean completion round in each
+    iteration.  Iterations are independent, so those give confidence
+    intervals on the class means (see intervals()).
+    """
+    def __init__(self, peer_ids, peer_classes=None):
+        """peer_classes: the agent class name of each peer, in order"""
+        self.peer_ids = peer_ids[:]
+        self.iterations = 0
+        self.uploaded = dict((id, RunningStats()) for id in peer_ids)
+        self.completion = dict((id, RunningStats()) for id in peer_ids)
+        self.completion_quantiles = dict((id, QuantileSketch())
+                                         for id in peer_ids)
+        self.classes = dict()   # class name -> [peer_id]
+        for (id, name) in zip(peer_ids, peer_classes or ()):
+            self.classes.setdefault(name, []).append(id)
+        self.class_uploaded = dict((c, RunningStats()) for c in self.classes)
+        self.class_completion = dict((c, RunningStats())
+                                     for c in self.classes)
+        # class name -> iterations where some peer of the class didn't finish
+        self.class_unfinished = dict((c, 0) for c in self.classes)
+
+    def add(self, summary):
+        """summary: one iteration's Stats.summary"""
+        (uploaded, completion) = summary
+        self.iterations += 1
+        for id in self.peer_ids:
+            self.uploaded[id].add(uploaded[id])
+            if completion[id] is not None:
+                self.completion[id].add(completion[id])
+                self.completion_quantiles[id].add(completion[id])
+        for (name, ids) in self.classes.items():
+            self.class_uploaded[name].add(
+                sum(uploaded[id] for id in ids) / float(len(ids)))
+            rounds = [completion[id] for id in ids]
+            if None in rounds:
+                self.class_unfinished[name] += 1
+            else:
+                self.class_completion[name].add(sum(rounds) / float(len(ids)))
+
+    def merge(self, other):
+        self.iterations += other.iterations
+        for id in self.peer_ids:
+            self.uploaded[id].merge(other.uploaded[id])
+            self.completion[id].merge(other.completion[id])
+            self.completion_quantiles[id].merge(other.completion_quantiles[id])
+        for name in self.classes:
+            self.class_uploaded[name].merge(other.class_uploaded[name])
+            self.class_completion[name].merge(other.class_completion[name])
+            self.class_unfinished[name] += other.class_unfinished[name]
+
+    def intervals(self):
+        """
+        Returns dict: class name -> {"uploaded": (mean, half width),
+        "completion": (mean, half width)}, the 95% confidence intervals on
+        the class's mean per iteration.  A half width is None until there
+        are 2 iterations to go on.  The completion interval is (None, None)
+        if some peer of the class didn't finish in some iteration.
+        """
+        ans = dict()
+        for name in self.classes:
+            u = self.class_uploaded[name]
+            c = self.class_completion[name]
+            if self.class_unfinished[name]:
+                completion = (None, None)
+            else:
+                completion = (c.mean(), c.half_width())
+            ans[name] = {"uploaded": (u.mean(), u.half_width()),
+                         "completion": completion}
+        return ans
+
+    def widest_interval(self):
+        """
+        The interval that's widest relative to its mean, as (class name,
+        "uploaded" or "completion", full width / mean).  The width is
+        infinite while there's nothing to go on.  None if there are no
+        classes.
+        """
+        worst = None
+        for (name, by_stat) in sorted(self.intervals().items()):
+            for stat in ("completion", "uploaded"):
+                (mean, half) = by_stat[stat]
+                if half is None:
+                    width = float("inf")
+                elif half == 0:
+                    width = 0.0
+                elif mean == 0:
+                    width = float("inf")
+                else:
+                    width = 2 * half / abs(mean)
+                if worst is None or width > worst[2]:
+                    worst = (name, stat, width)
+        return worst
+
+    def result(self):
+        """
+        Returns dict: peer_id -> dict with the mean and stddev of uploaded
+        blocks and completion round over the iterations.  The completion
+        mean and stddev are None if the peer didn't finish in some
+        iteration; the p50 and p95 are over the iterations it did finish.
+        """
+        ans = dict()
+        for id in self.peer_ids:
+            u = self.uploaded[id]
+            c = self.completion[id]
+            q = self.completion_quantiles[id]
+            all_finished = c.n == self.iterations
+            ans[id] = {
+                "uploaded_mean": u.mean(),
+                "uploaded_stddev": u.stddev(),
+                "completion_mean": c.mean() if all_finished else None,
+                "completion_stddev": c.stddev() if all_finished else None,
+                "completion_p50": q.quantile(50),
+                "completion_p95": q.quantile(95),
+                "finished": c.n,
+            }
+        return ans
+
+
 class Stats:
     @staticmethod
     def uploaded_blocks(peer_ids, history):
@@ -10,13 +230,8 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        totals = history.blocks_uploaded()
+        return dict((peer_id, totals[peer_id]) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -43,9 +258,19 @@ class Stats:
         """ Return a pretty stringified version of completion_rounds """
         d = Stats.completion_rounds(peer_ids, history)
 
-        k = lambda id: d[id]
+        # Peers that didn't finish go last
+        k = lambda id: (d[id] is None, d[id] or 0)
         return "\n".join("%s: %s" % (id, d[id])
-                         for id in sorted(list(d.keys()), key=d.__getitem__))
+                         for id in sorted(list(d.keys()), key=k))
+
+    @staticmethod
+    def summary(peer_ids, history):
+        """
+        The compact per-iteration result that run_sim aggregates:
+        (uploaded_blocks dict, completion_rounds dict)
+        """
+        return (Stats.uploaded_blocks(peer_ids, history),
+                Stats.completion_rounds(peer_ids, history))
 
     @staticmethod
     def all_done_round(peer_ids, history):
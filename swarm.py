@@ -0,0 +1,589 @@
+#!/usr/bin/python
+
+"""
+The piece state of the whole swarm: how many blocks of each piece every peer
+has, which pieces each peer can share, and who is finished.
+
+There are two interchangeable engines:
+  - SwarmState keeps everything in python lists and sets.  It's the default.
+  - ArraySwarmState keeps the state in numpy arrays, and validates and
+    resolves a whole round of requests with vectorized operations.  Use it
+    for big swarms.  numpy is only imported when this engine is used.
+
+Either way, agents see the same thing: a tuple of their own pieces, and a
+PieceSet of available pieces per peer (through PeerInfo).  The PeerInfos are
+kept from round to round and only replaced when a peer finishes a piece.
+"""
+
+import itertools
+from array import array
+from operator import itemgetter, gt
+from types import MappingProxyType
+
+# numpy, imported the first time the numpy engine is used, so the list
+# engine doesn't need it installed or pay for loading it
+np = None
+
+from messages import (Request, RequestBatch, Download, PeerInfo, SwarmInfo,
+                      PiecesView)
+from pieceset import PieceSet
+from util import IllegalRequest
+
+
+def load_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("The numpy engine needs numpy installed")
+        np = numpy
+
+
+def make_swarm_state(conf, peer_ids, initial_pieces):
+    """
+    conf.engine picks the engine: 'lists' (the default) or 'numpy'.
+    initial_pieces: dict : peer_id -> list (blocks / piece)
+    """
+    engine = getattr(conf, "engine", "lists")
+    if engine == "lists":
+        return SwarmState(conf, peer_ids, initial_pieces)
+    elif engine == "numpy":
+        return ArraySwarmState(conf, peer_ids, initial_pieces)
+    raise ValueError("Unknown engine: %s" % engine)
+
+
+class SwarmState:
+    """
+    peer_pieces: dict : peer_id -> list (blocks / piece)
+    available: dict : peer_id -> PieceSet(finished / available pieces).
+        PieceSets are immutable, so they can be handed to agents as is.
+    remaining: dict : peer_id -> blocks still missing
+    done: set of peer ids that have the whole file
+    piece_counts: list : piece id -> number of peers that have the piece
+    rarity_masks: list : count -> bit mask of the pieces exactly that many
+        peers have.  Along with piece_counts, kept up to date as pieces
+        complete, so agents don't have to recount every round.
+    peer_infos: list : peer index -> the PeerInfo agents see for that peer
+    """
+    def __init__(self, conf, peer_ids, initial_pieces):
+        self.conf = conf
+        self.peer_ids = peer_ids[:]
+        self.peer_index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+
+        bpp = conf.blocks_per_piece
+        file_blocks = conf.num_pieces * bpp
+        self.peer_pieces = dict((pid, list(initial_pieces[pid]))
+                                for pid in peer_ids)
+        self.available = dict(
+            (pid, PieceSet(i for (i, b) in enumerate(self.peer_pieces[pid])
+                           if b == bpp))
+            for pid in peer_ids)
+        # Kept up to date as blocks arrive, so checking for completion is
+        # O(1) per peer.
+        self.remaining = dict((pid, file_blocks - sum(self.peer_pieces[pid]))
+                              for pid in peer_ids)
+        self.done = set(pid for pid in peer_ids if self.remaining[pid] == 0)
+        # Finished, but not yet collected by take_newly_done()
+        self.newly_done = [pid for pid in peer_ids if pid in self.done]
+
+        self.piece_counts = [0] * conf.num_pieces
+        for pid in peer_ids:
+            for i in self.available[pid]:
+                self.piece_counts[i] += 1
+        self.init_views()
+
+    def init_views(self):
+        """Set up the rarity buckets and PeerInfos swarm_info() hands out"""
+        groups = [[] for _ in range(len(self.peer_ids) + 1)]
+        for (i, count) in enumerate(self.piece_counts):
+            groups[int(count)].append(i)
+        self.rarity_masks = [PieceSet(g).mask for g in groups]
+        self.peer_infos = [PeerInfo(pid, self.available[pid])
+                           for pid in self.peer_ids]
+
+    def piece_completed(self, peer_id, piece_id):
+        """Record that peer_id now has all of piece_id"""
+        available = self.available[peer_id].with_piece(piece_id)
+        self.available[peer_id] = available
+        self.peer_infos[self.peer_index[peer_id]] = PeerInfo(peer_id,
+                                                             available)
+        count = int(self.piece_counts[piece_id])
+        self.piece_counts[piece_id] = count + 1
+        bit = 1 << piece_id
+        self.rarity_masks[count] ^= bit
+        self.rarity_masks[count + 1] |= bit
+
+    def swarm_info(self):
+        """This round's SwarmInfo, shared by all agents"""
+        groups = tuple((count, PieceSet.from_mask(mask))
+                       for (count, mask) in enumerate(self.rarity_masks)
+                       if mask)
+        return SwarmInfo(tuple(self.piece_counts), groups,
+                         tuple(self.peer_infos),
+                         MappingProxyType(self.peer_index))
+
+    def pieces_of(self, peer_id):
+        """A read-only view of this peer's blocks per piece"""
+        return PiecesView(self.peer_pieces[peer_id])
+
+    def completed_pieces(self, peer_id):
+        return len(self.available[peer_id])
+
+    def take_newly_done(self):
+        """Return the peers that finished since the last call, in peer order"""
+        ans = self.newly_done
+        self.newly_done = []
+        return ans
+
+    def all_done(self):
+        return len(self.done) == len(self.peer_ids)
+
+    def check_requests(self, requests, check_ids):
+        """
+        requests: dict : peer_id -> list of Requests or RequestBatch made by
+            that peer
+        check_ids: the peers whose requests should be validated.  The others
+            are trusted as is.
+
+        Raise an IllegalRequest exception if there is a problem.  Returns
+        whatever apply_transfers() needs to resolve these requests.
+        """
+        masks = None
+        for peer_id in requests:
+            rs = requests[peer_id]
+            if peer_id in check_ids:
+                if isinstance(rs, RequestBatch):
+                    if masks is None:
+                        masks = self.peer_masks()
+                    self.check_peer_batch(peer_id, rs, masks)
+                else:
+                    self.check_peer_requests(peer_id, rs)
+            elif isinstance(rs, RequestBatch):
+                self.check_batch_peers(rs)
+        return requests
+
+    def check_batch_peers(self, batch):
+        """
+        Peer indexes outside swarm.peers would wrap around to other peers,
+        or crash the sim, so they're checked even in batches that are
+        otherwise trusted.  Just a min and a max.
+        """
+        (peers, n) = (batch.peers, len(self.peer_ids))
+        if len(peers) and (min(peers) < 0 or max(peers) >= n):
+            k = next(k for k in range(len(peers)) if not 0 <= peers[k] < n)
+            r = Request(batch.requester_id, peers[k], batch.pieces[k],
+                        batch.starts[k])
+            raise IllegalRequest("Request mentions non-existent peer!"
+                                 " Bad element: %s" % r)
+
+    def check_peer_requests(self, peer_id, requests):
+        """Check every rule for each request in a single pass"""
+        num_pieces = self.conf.num_pieces
+        bpp = self.conf.blocks_per_piece
+        pieces = self.peer_pieces[peer_id]
+        available = self.available
+
+        def bad(msg, r):
+            raise IllegalRequest(msg + " Bad element: %s" % r)
+
+        for r in requests:
+            if not isinstance(r, Request):
+                bad("List of Requests contains non-Request object.", r)
+            if r.piece_id < 0 or r.piece_id >= num_pieces:
+                bad("Request asks for non-existent piece!", r)
+            if r.peer_id not in available:
+                bad("Request mentions non-existent peer!", r)
+            if r.requester_id != peer_id:
+                bad("Request has wrong peer id!", r)
+            # Must request the _next_ necessary block
+            if r.start < 0 or r.start >= bpp or r.start > pieces[r.piece_id]:
+                bad("Request has bad start block!", r)
+            if r.piece_id not in available[r.peer_id]:
+                bad("Asking for piece peer does not have!", r)
+
+        # If we got here, looks ok
+
+    def check_peer_batch(self, peer_id, batch, masks):
+        """
+        The same rules as check_peer_requests(), for a RequestBatch.  The
+        range checks look at the whole arrays at once.
+        masks: peer_masks()
+        """
+        bpp = self.conf.blocks_per_piece
+        pieces = self.peer_pieces[peer_id]
+        ids = self.peer_ids
+        n = len(ids)
+        (peers, piece_ids, starts) = (batch.peers, batch.pieces, batch.starts)
+
+        def bad(msg, k):
+            j = peers[k]
+            r = Request(batch.requester_id, ids[j] if 0 <= j < n else j,
+                        piece_ids[k], starts[k])
+            raise IllegalRequest(msg + " Bad element: %s" % r)
+
+        def first(test):
+            return next(k for k in range(len(peers)) if test(k))
+
+        if batch.requester_id != peer_id:
+            raise IllegalRequest("Request has wrong peer id!"
+                                 " Bad element: %s" % batch)
+        if not len(peers):
+            return
+        if min(piece_ids) < 0 or max(piece_ids) >= self.conf.num_pieces:
+            bad("Request asks for non-existent piece!",
+                first(lambda k: not 0 <= piece_ids[k] < self.conf.num_pieces))
+        if min(peers) < 0 or max(peers) >= n:
+            bad("Request mentions non-existent peer!",
+                first(lambda k: not 0 <= peers[k] < n))
+        if min(starts) < 0 or max(starts) >= bpp:
+            bad("Request has bad start block!",
+                first(lambda k: not 0 <= starts[k] < bpp))
+        # Must request the _next_ necessary block
+        if any(map(gt, starts, map(pieces.__getitem__, piece_ids))):
+            bad("Request has bad start block!",
+                first(lambda k: starts[k] > pieces[piece_ids[k]]))
+        for (j, piece_id) in zip(peers, piece_ids):
+            if not (masks[j] >> piece_id) & 1:
+                bad("Asking for piece peer does not have!",
+                    first(lambda k: not (masks[peers[k]] >> piece_ids[k]) & 1))
+
+    def peer_masks(self):
+        """The available pieces of every peer, as bit masks in peer order"""
+        return [info.available_pieces.mask for info in self.peer_infos]
+
+    def apply_transfers(self, requests, uploads):
+        """
+        Process the uploads: figure out how many blocks of all the requested
+        pieces the requesters ended up with.
+        Make sure requesting the same thing from lots of peers doesn't
+        stack.
+        update the sets of available pieces as needed.
+
+        Only the blocks that actually moved are applied, in place, so the
+        cost scales with the transfers rather than the size of the swarm.
+        Returns (set of peer ids whose pieces changed, downloads)
+        """
+        conf = self.conf
+
+        def upload_rate(uploader_id, requester_id):
+            """
+            return the uploading rate from uploader to requester
+            in blocks per time period, or 0 if not uploading.
+            """
+            for u in uploads[uploader_id]:
+                if u.to_id == requester_id:
+                    return u.bw
+            return 0
+
+        downloads = dict((pid, []) for pid in self.peer_ids)
+        changed = set()
+        for requester_id in requests:
+            # Keep track of how many blocks of each piece this
+            # requester got.  piece -> (blocks, from_who)
+            new_blocks_per_piece = dict()
+            def update_count(piece_id, blocks, peer_id):
+                if piece_id in new_blocks_per_piece:
+                    old = new_blocks_per_piece[piece_id][0]
+                    if blocks > old:
+                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
+                else:
+                    new_blocks_per_piece[piece_id] = (blocks, peer_id)
+
+            # Group the requests by peer that is being asked, as
+            # (peer_id, piece_id, start)
+            rs = requests[requester_id]
+            if isinstance(rs, RequestBatch):
+                ids = self.peer_ids
+                rs = zip([ids[j] for j in rs.peers], rs.pieces, rs.starts)
+            else:
+                rs = ((r.peer_id, r.piece_id, r.start) for r in rs)
+            get_peer_id = itemgetter(0)
+            rs = sorted(rs, key=get_peer_id)
+            for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
+                bw = upload_rate(peer_id, requester_id)
+                if bw == 0:
+                    continue
+                # This bandwidth gets applied in order to each piece requested
+                for (_, piece_id, start) in rs_for_peer:
+                    needed_blocks = conf.blocks_per_piece - start
+                    alloced_bw = min(bw, needed_blocks)
+                    update_count(piece_id, alloced_bw, peer_id)
+                    bw -= alloced_bw
+                    if bw == 0:
+                        break
+            pieces = self.peer_pieces[requester_id]
+            for piece_id in new_blocks_per_piece:
+                (blocks, peer_id) = new_blocks_per_piece[piece_id]
+                pieces[piece_id] += blocks
+                if pieces[piece_id] == conf.blocks_per_piece:
+                    self.piece_completed(requester_id, piece_id)
+                d = Download(peer_id, requester_id, piece_id, blocks)
+                downloads[requester_id].append(d)
+                self.remaining[requester_id] -= blocks
+            if new_blocks_per_piece:
+                changed.add(requester_id)
+                if self.remaining[requester_id] == 0:
+                    self.done.add(requester_id)
+                    self.newly_done.append(requester_id)
+
+        return (changed, downloads)
+
+
+class ArraySwarmState(SwarmState):
+    """
+    Same interface as SwarmState, with the state in numpy arrays:
+
+    blocks: int array, peers x pieces -- blocks received.  Float, along with
+        remaining, once an uploader sends a fractional bandwidth.
+    have: bool array, peers x pieces -- finished / available pieces
+    piece_counts: int array, one entry per piece -- how many peers have it
+    remaining: int array, one entry per peer -- blocks still missing
+
+    Peers are indexed in peer_ids order.  The available PieceSets handed to
+    agents are kept alongside, updated as pieces complete.
+    """
+    def __init__(self, conf, peer_ids, initial_pieces):
+        load_numpy()
+        self.conf = conf
+        self.peer_ids = peer_ids[:]
+        self.peer_index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        # Requests are resolved in peer id order, as the list engine does.
+        order = sorted(range(len(peer_ids)), key=lambda i: peer_ids[i])
+        self.id_rank = np.empty(len(peer_ids), dtype=np.int64)
+        self.id_rank[order] = np.arange(len(peer_ids))
+
+        bpp = conf.blocks_per_piece
+        self.blocks = np.array([initial_pieces[pid] for pid in peer_ids],
+                               dtype=np.int32).reshape(len(peer_ids),
+                                                       conf.num_pieces)
+        self.have = self.blocks == bpp
+        self.piece_counts = self.have.sum(axis=0)
+        self.remaining = (conf.num_pieces * bpp -
+                          self.blocks.sum(axis=1, dtype=np.int64))
+        self.available = dict(
+            (pid, PieceSet(np.flatnonzero(self.have[i]).tolist()))
+            for (i, pid) in enumerate(peer_ids))
+        self.done = set(pid for (i, pid) in enumerate(peer_ids)
+                        if self.remaining[i] == 0)
+        self.newly_done = [pid for pid in peer_ids if pid in self.done]
+        self.init_views()
+
+    def __setstate__(self, state):
+        # Restored from a checkpoint, without __init__
+        load_numpy()
+        self.__dict__.update(state)
+
+    def pieces_of(self, peer_id):
+        # A view on the row, not a copy.  If blocks turns float, the peers
+        # whose rows change get views on the new array.
+        row = self.blocks[self.peer_index[peer_id]]
+        return PiecesView(memoryview(row).toreadonly())
+
+    def swarm_info(self):
+        groups = tuple((count, PieceSet.from_mask(mask))
+                       for (count, mask) in enumerate(self.rarity_masks)
+                       if mask)
+        counts = self.piece_counts.view()
+        counts.flags.writeable = False
+        return SwarmInfo(counts, groups, tuple(self.peer_infos),
+                         MappingProxyType(self.peer_index))
+
+    def check_requests(self, requests, check_ids):
+        """
+        Validate the whole round at once.  Returns the requests encoded as
+        parallel arrays (requester, peer, piece, start), which is what
+        apply_transfers() works on.  RequestBatches already are arrays, so
+        they're used as is.
+        """
+        conf = self.conf
+        index = self.peer_index
+        ids = self.peer_ids
+        n = len(ids)
+        # Batches are copied into one set of arrays as is, and lists are
+        # encoded into another.  Only the order within each requester's
+        # requests matters.
+        b_req = []
+        b_counts = []
+        b_checked = []
+        (b_peer, b_piece, b_start) = (array("i"), array("i"), array("i"))
+        (l_req, l_peer, l_piece, l_start, l_checked) = ([], [], [], [], [])
+        for requester_id in requests:
+            i = index[requester_id]
+            check = requester_id in check_ids
+            rs = requests[requester_id]
+            if isinstance(rs, RequestBatch):
+                if check and rs.requester_id != requester_id:
+                    raise IllegalRequest("Request has wrong peer id!"
+                                         " Bad element: %s" % rs)
+                if not check:
+                    # Checked ones get the vectorized checks below
+                    self.check_batch_peers(rs)
+                b_req.append(i)
+                b_counts.append(len(rs))
+                b_checked.append(check)
+                b_peer.extend(rs.peers)
+                b_piece.extend(rs.pieces)
+                starts = rs.starts
+                if starts.typecode != b_start.typecode:
+                    # Some starts are fractional, so make them all floats
+                    if b_start.typecode == "i":
+                        b_start = array("d", b_start)
+                    else:
+                        starts = array("d", starts)
+                b_start.extend(starts)
+                continue
+            # The per-object checks can't be vectorized; do them while
+            # encoding.
+            for r in rs:
+                if check:
+                    if not isinstance(r, Request):
+                        raise IllegalRequest(
+                            "List of Requests contains non-Request object."
+                            " Bad element: %s" % r)
+                    if r.requester_id != requester_id:
+                        raise IllegalRequest("Request has wrong peer id!"
+                                             " Bad element: %s" % r)
+                    if r.peer_id not in index:
+                        raise IllegalRequest(
+                            "Request mentions non-existent peer!"
+                            " Bad element: %s" % r)
+                l_req.append(i)
+                l_peer.append(index[r.peer_id])
+                l_piece.append(r.piece_id)
+                l_start.append(r.start)
+                l_checked.append(check)
+
+        def join(batch_col, list_col, dtype=np.int64):
+            return np.concatenate([np.array(batch_col, dtype=dtype),
+                                   np.array(list_col, dtype=dtype)])
+
+        req = join(np.repeat(np.array(b_req, dtype=np.int64), b_counts), l_req)
+        peer = join(b_peer, l_peer)
+        piece = join(b_piece, l_piece)
+        # Fractional uploads leave fractional blocks, so starts can be too
+        fractional = (b_start.typecode == "d" or
+                      any(isinstance(x, float) for x in l_start))
+        start = join(b_start, l_start, np.float64 if fractional else np.int64)
+        checked = join(np.repeat(np.array(b_checked, dtype=bool), b_counts),
+                       l_checked, bool)
+        if not checked.any():
+            return (req, peer, piece, start)
+
+        def check(bad, msg):
+            bad &= checked
+            if bad.any():
+                i = int(np.argmax(bad))
+                j = int(peer[i])
+                r = Request(ids[req[i]], ids[j] if 0 <= j < n else j,
+                            int(piece[i]), int(start[i]))
+                raise IllegalRequest(msg + " Bad element: %s" % r)
+
+        check((peer < 0) | (peer >= n), "Request mentions non-existent peer!")
+        check((piece < 0) | (piece >= conf.num_pieces),
+              "Request asks for non-existent piece!")
+        # Must request the _next_ necessary block
+        check((start < 0) | (start >= conf.blocks_per_piece) |
+              (start > self.blocks[req, piece]),
+              "Request has bad start block!")
+        check(~self.have[peer, piece], "Asking for piece peer does not have!")
+
+        return (req, peer, piece, start)
+
+    def apply_transfers(self, requests, uploads):
+        """
+        Vectorized version of SwarmState.apply_transfers().  requests is the
+        encoding returned by check_requests().  Each requester gets, per
+        piece, the most blocks any single uploader sent it (ties go to the
+        uploader processed first), and each uploader's bandwidth to a
+        requester is applied in order to the pieces requested from it.
+        """
+        conf = self.conf
+        n = len(self.peer_ids)
+        (req, peer, piece, start) = requests
+        downloads = dict((pid, []) for pid in self.peer_ids)
+
+        # Upload rate for each request.  Only the first upload from an
+        # uploader to a requester counts.
+        index = self.peer_index
+        up_keys = []
+        up_bws = []
+        for uploader_id in uploads:
+            u_i = index[uploader_id]
+            for u in uploads[uploader_id]:
+                j = index.get(u.to_id)
+                if j is None:
+                    # Not a peer, so nobody gets it, as in SwarmState
+                    continue
+                up_keys.append(u_i * n + j)
+                up_bws.append(u.bw)
+        if len(req) == 0 or len(up_keys) == 0:
+            return (set(), downloads)
+        (keys, first) = np.unique(np.array(up_keys, dtype=np.int64),
+                                  return_index=True)
+        # Whatever type the bandwidths are: SwarmState takes fractional ones
+        # as they come
+        rates = np.array(up_bws)[first]
+        req_keys = peer * n + req
+        pos = np.minimum(np.searchsorted(keys, req_keys), len(keys) - 1)
+        bw = np.where(keys[pos] == req_keys, rates[pos], 0)
+
+        # Process requests grouped by (requester, uploader), uploaders in id
+        # order, and in the order they were made within a group.
+        order = np.lexsort((np.arange(len(req)), self.id_rank[peer], req))
+        order = order[bw[order] > 0]
+        if len(order) == 0:
+            return (set(), downloads)
+        (req, peer, piece, start, bw) = (req[order], peer[order],
+                                         piece[order], start[order], bw[order])
+        needed = conf.blocks_per_piece - start
+        group = req * n + peer
+        first_in_group = np.r_[True, group[1:] != group[:-1]]
+        group_id = np.cumsum(first_in_group) - 1
+        used_before = np.cumsum(needed) - needed
+        used_before -= used_before[first_in_group][group_id]
+        alloced = np.minimum(needed, np.maximum(bw - used_before, 0))
+
+        # Per (requester, piece), keep the best uploader.  The position in
+        # processing order breaks ties, and also gives the order in which
+        # each requester first saw its pieces.
+        got = alloced > 0
+        positions = np.flatnonzero(got)
+        (req, peer, piece, alloced) = (req[got], peer[got], piece[got],
+                                       alloced[got])
+        best = np.lexsort((positions, -alloced, piece, req))
+        pair = req[best] * conf.num_pieces + piece[best]
+        first_in_pair = np.r_[True, pair[1:] != pair[:-1]]
+        first_seen = np.minimum.reduceat(positions[best],
+                                         np.flatnonzero(first_in_pair))
+        winners = best[first_in_pair]
+        winners = winners[np.lexsort((first_seen, req[winners]))]
+        (w_req, w_peer, w_piece, w_blocks) = (req[winners], peer[winners],
+                                              piece[winners], alloced[winners])
+
+        # Apply the deltas
+        if w_blocks.dtype.kind == "f" and self.blocks.dtype.kind != "f":
+            # Fractional bandwidths give fractional blocks, as they do in
+            # SwarmState
+            self.blocks = self.blocks.astype(np.float64)
+            self.remaining = self.remaining.astype(np.float64)
+        self.blocks[w_req, w_piece] += w_blocks.astype(self.blocks.dtype)
+        finished = self.blocks[w_req, w_piece] == conf.blocks_per_piece
+        self.have[w_req[finished], w_piece[finished]] = True
+        np.subtract.at(self.remaining, w_req, w_blocks)
+
+        ids = self.peer_ids
+        for (i, j, p, b, f) in zip(w_req.tolist(), w_peer.tolist(),
+                                   w_piece.tolist(), w_blocks.tolist(),
+                                   finished.tolist()):
+            requester_id = ids[i]
+            downloads[requester_id].append(Download(ids[j], requester_id, p, b))
+            if f:
+                self.piece_completed(requester_id, p)
+
+        changed_idx = np.unique(w_req)
+        for i in changed_idx[self.remaining[changed_idx] == 0].tolist():
+            if ids[i] not in self.done:
+                self.done.add(ids[i])
+                self.newly_done.append(ids[i])
+        return (set(ids[i] for i in changed_idx.tolist()), downloads)
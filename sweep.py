@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Runs a grid of simulation configurations in one process tree, instead of
+calling sim.py once per configuration from a shell loop.
+
+The grid spec is a JSON file mapping each sim setting to a list of values to
+try.  Every combination is one cell.  For example:
+
+    {
+      "agents": ["WalziStd,10 WalziTyrant,5 Seed,2",
+                 "WalziStd,15 Seed,2"],
+      "num_pieces": [64, 128],
+      "blocks_per_piece": [4],
+      "min_up_bw": [4],
+      "max_up_bw": [10, 16],
+      "max_round": [500],
+      "iters": 20,
+      "validation": "off",
+      "seed": 1
+    }
+
+A single value is the same as a one-element list.  Settings left out get the
+sim.py defaults.  Sweeps over in-house agents can turn validation off, or
+use "sampled".  "seed" is the base seed for the whole sweep; each cell gets
+its own seed derived from it and the cell's settings, so adding values to
+an axis leaves the seeds of the cells already there alone.
+
+Cells are spread across worker processes, and each finished cell is appended
+to the results file as one line of JSON.  Running the same sweep again with
+the same results file skips the cells that are already there with the same
+seed, so an interrupted sweep picks up where it left off.
+
+With --cache DIR, each iteration's result is also kept in a cache (see
+cache.py), so after editing an agent, running the sweep again into a new
+results file only reruns the cells that agent is in.
+"""
+
+import sys
+import json
+import hashlib
+import logging
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+from sim import Sim, make_config, parse_agents, configure_logging
+
+# Grid settings, in the order cells are enumerated, and their sim.py defaults
+SETTINGS = [("agents", "Dummy,2 Seed"),
+            ("num_pieces", 3),
+            ("blocks_per_piece", 4),
+            ("max_round", 5),
+            ("min_up_bw", 4),
+            ("max_up_bw", 10),
+            ("iters", 1),
+            ("engine", "lists"),
+            ("validation", "full"),
+            ("validate_every", 10)]
+
+
+def grid_cells(spec):
+    """
+    Returns the list of cells in the grid: dicts : setting -> value.
+    """
+    known = set(name for (name, _) in SETTINGS) | set(["seed"])
+    unknown = set(spec.keys()) - known
+    if unknown:
+        raise ValueError("Unknown settings in grid spec: %s" %
+                         ", ".join(sorted(unknown)))
+
+    def values(name, default):
+        v = spec.get(name, default)
+        return v if isinstance(v, list) else [v]
+
+    names = [name for (name, _) in SETTINGS]
+    axes = [values(name, default) for (name, default) in SETTINGS]
+    return [dict(zip(names, combo)) for combo in itertools.product(*axes)]
+
+
+def cell_seed(base_seed, cell):
+    """The seed for cell: a hash of base_seed and the cell's settings"""
+    text = "%d:%s" % (base_seed, json.dumps(cell, sort_keys=True))
+    digest = hashlib.sha256(text.encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def cell_key(cell, seed):
+    """The cell's settings and its seed: what its results depend on"""
+    return json.dumps(dict(cell, seed=seed), sort_keys=True)
+
+
+def run_cell(job):
+    """
+    Run every iteration of one cell.  job is (cell, seed, cache settings
+    for make_config)
+    """
+    (cell, seed, cache_settings) = job
+    agents = parse_agents(cell["agents"].split())
+    settings = dict((k, v) for (k, v) in cell.items() if k != "agents")
+    settings.update(cache_settings)
+    config = make_config(agents, seed=seed, **settings)
+    stats = Sim(config).run_iterations()
+    return {"key": cell_key(cell, seed),
+            "cell": cell,
+            "seed": seed,
+            "peers": stats.result()}
+
+
+def finished_keys(results_file):
+    """Keys of the cells already in results_file"""
+    keys = set()
+    try:
+        f = open(results_file)
+    except IOError:
+        return keys
+    with f:
+        for line in f:
+            try:
+                keys.add(json.loads(line)["key"])
+            except (ValueError, KeyError):
+                # Probably a line cut short when the last sweep was killed
+                continue
+    return keys
+
+
+def run_sweep(spec, results_file, workers=1, cache=None, cache_size=100):
+    """
+    Run every cell of the grid that isn't already in results_file, appending
+    results as they come in.  cache is a result cache directory, or None.
+    Returns the number of cells run.
+    """
+    base_seed = spec.get("seed", 0)
+    cells = grid_cells(spec)
+    done = finished_keys(results_file)
+    # The seed depends only on the cell's settings, so resuming or growing
+    # the grid doesn't change the results.
+    cache_settings = {"cache": cache, "cache_size": cache_size}
+    seeds = [cell_seed(base_seed, cell) for cell in cells]
+    jobs = [(cell, seed, cache_settings)
+            for (cell, seed) in zip(cells, seeds)
+            if cell_key(cell, seed) not in done]
+    logging.warning("%d cells, %d already done, %d to run" % (
+        len(cells), len(cells) - len(jobs), len(jobs)))
+
+    with open(results_file, "a") as out:
+        def record(result):
+            out.write(json.dumps(result, sort_keys=True) + "\n")
+            out.flush()
+            logging.warning("Finished %s" % result["key"])
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                for result in pool.imap_unordered(run_cell, jobs):
+                    record(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                record(run_cell(job))
+    return len(jobs)
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] GRID_SPEC.json"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'debug', 'info' or 'warning'")
+
+    parser.add_option("--results",
+                      dest="results", default="sweep_results.jsonl",
+                      help="File to append results to, one JSON line per cell."
+                      "  Cells already in it are skipped.")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to spread cells across")
+
+    parser.add_option("--cache",
+                      dest="cache", default=None,
+                      help="Result cache directory to reuse iterations from"
+                      " (see cache.py)")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=100, type="float",
+                      help="Keep the --cache under this many megabytes")
+
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    configure_logging(options.loglevel)
+    with open(args[0]) as f:
+        spec = json.load(f)
+    run_sweep(spec, options.results, options.workers, options.cache,
+              options.cache_size)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+Plays agent classes against each other and ranks them, instead of
+assembling sim.py command lines by hand.
+
+    python tournament.py --format round-robin --size 5 --extra Seed,2 \
+        WalziStd WalziTyrant WalziPropShare WalziTourney
+
+Formats, for classes A, B, C, ... and --size N:
+  - round-robin: one matchup per pair of classes, N peers of each
+  - all-vs-all: one matchup with N peers of every class
+  - one-vs-field: one matchup per class, where a single peer of it plays
+    a field of N peers of each of the other classes.  Only the lone peer
+    is ranked.
+
+The --extra peers (usually seeds) join every matchup and aren't ranked.
+
+Every iteration of every matchup is its own job, and the jobs are spread
+across worker processes in order.  There's no point starting the costly
+ones first: the matchups of a tournament all have the same number of
+peers (--extra included), --max-round and --iters, so no job is known to
+take longer than another.  Each iteration's per-class means (completion
+round, uploaded blocks) are one sample for that class; the ranking pools
+a class's samples over all its matchups, and gives 95% confidence
+intervals on the means.
+
+With --cache DIR, iteration results are reused from a result cache (see
+cache.py), so after editing one agent only the matchups it's in rerun.
+
+Matchup m is run with seed derive_seed(--seed, m), so sim.py with that
+--seed, the matchup's peers and the same settings and --iters replays it.
+The seeds are in the --out file.
+"""
+
+import sys
+import json
+import logging
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+from util import derive_seed
+from stats import RunningStats, SummaryStats
+from sim import (make_config, make_peer_ids, parse_agents,
+                 configure_logging, run_iteration)
+
+FORMATS = ["round-robin", "all-vs-all", "one-vs-field"]
+
+
+def make_matchups(classes, format, size, extra=()):
+    """
+    classes: agent class names to rank
+    extra: class names, one per peer, added to every matchup
+
+    Returns a list of (name, agents, ranked): agents has a class name per
+    peer, as sim.make_config wants, and ranked is the classes that count.
+    """
+    extra = list(extra)
+    both = sorted(set(classes) & set(extra))
+    if both:
+        # Their --extra peers would count towards the ranked ones
+        raise ValueError("Ranked classes can't also be --extra: %s" %
+                         ", ".join(both))
+    if format == "round-robin":
+        return [("%s vs %s" % (a, b), [a] * size + [b] * size + extra, [a, b])
+                for (a, b) in itertools.combinations(classes, 2)]
+    elif format == "all-vs-all":
+        return [("all", [c for c in classes for _ in range(size)] + extra,
+                 list(classes))]
+    elif format == "one-vs-field":
+        return [("%s vs field" % c,
+                 [c] + [o for o in classes if o != c for _ in range(size)] +
+                 extra, [c])
+                for c in classes]
+    raise ValueError("Unknown format: %s" % format)
+
+
+def run_tournament(classes, format, size, extra=(), iters=1, workers=1,
+                   seed=0, **settings):
+    """
+    Run every matchup for iters iterations.  settings go to
+    sim.make_config.  Returns (matchups, ranking): see ranking_table for
+    the ranking; matchups is a list of dicts with the name, seed, agents
+    and per-peer SummaryStats.result() of each matchup.
+    """
+    matchups = make_matchups(classes, format, size, extra)
+    if not matchups:
+        raise ValueError("%s needs more classes" % format)
+    configs = [make_config(agents, iters=iters, **settings)
+               for (_, agents, _) in matchups]
+    seeds = [derive_seed(seed, m) for m in range(len(matchups))]
+    # Same iteration seeds as sim.py --seed gives each matchup
+    jobs = [(m, (configs[m], derive_seed(seeds[m], i), i))
+            for m in range(len(matchups)) for i in range(iters)]
+    logging.warning("%d matchups, %d iterations each, %d jobs" % (
+        len(matchups), iters, len(jobs)))
+
+    results = dict()   # (matchup, iteration) -> Stats.summary
+    left = dict((m, iters) for m in range(len(matchups)))
+
+    def record(m, i, summary):
+        results[(m, i)] = summary
+        left[m] -= 1
+        if left[m] == 0:
+            logging.warning("Finished %s" % matchups[m][0])
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            tagged = pool.imap_unordered(run_job, jobs)
+            for (m, i, summary) in tagged:
+                record(m, i, summary)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            record(*run_job(job))
+
+    # Fold each matchup's iterations in order, so the sums don't depend on
+    # which job finished first
+    played = []
+    by_class = dict()  # class name -> SummaryStats per matchup it's ranked in
+    for (m, (name, agents, ranked)) in enumerate(matchups):
+        stats = SummaryStats(make_peer_ids(agents), agents)
+        for i in range(iters):
+            stats.add(results[(m, i)])
+        played.append({"name": name, "seed": seeds[m], "agents": agents,
+                       "peers": stats.result()})
+        for c in ranked:
+            by_class.setdefault(c, []).append(stats)
+    return (played, ranking_table(by_class))
+
+
+def run_job(job):
+    """One iteration of one matchup.  job is (matchup, sim job)"""
+    (m, sim_job) = job
+    return (m, sim_job[2], run_iteration(sim_job))
+
+
+def ranking_table(by_class):
+    """
+    by_class: dict : class name -> [SummaryStats of the matchups it's
+        ranked in]
+
+    Returns a list of dicts, best first, with the class name, the number
+    of samples, and the mean and 95% confidence half width of its
+    completion round and uploaded blocks over all of them.  Classes that
+    didn't always finish have no completion mean, and go last.
+    """
+    rows = []
+    for (c, all_stats) in by_class.items():
+        completion = RunningStats()
+        uploaded = RunningStats()
+        unfinished = 0
+        for stats in all_stats:
+            completion.merge(stats.class_completion[c])
+            uploaded.merge(stats.class_uploaded[c])
+            unfinished += stats.class_unfinished[c]
+        rows.append({"class": c,
+                     "samples": uploaded.n,
+                     "unfinished": unfinished,
+                     "completion_mean": (None if unfinished else
+                                         completion.mean()),
+                     "completion_ci": (None if unfinished else
+                                       completion.half_width()),
+                     "uploaded_mean": uploaded.mean(),
+                     "uploaded_ci": uploaded.half_width()})
+    rows.sort(key=lambda r: (r["completion_mean"] is None,
+                             r["completion_mean"] or 0, r["class"]))
+    return rows
+
+
+def format_ranking(ranking):
+    def interval(mean, half):
+        if mean is None:
+            return "None"
+        if half is None:
+            return "%.2f" % mean
+        return "%.2f +/- %.2f" % (mean, half)
+
+    lines = ["rank  class: completion round; uploaded blocks  (samples,"
+             " unfinished)"]
+    for (k, r) in enumerate(ranking):
+        lines.append("%d. %s: %s; %s  (%d, %d)" % (
+            k + 1, r["class"],
+            interval(r["completion_mean"], r["completion_ci"]),
+            interval(r["uploaded_mean"], r["uploaded_ci"]),
+            r["samples"], r["unfinished"]))
+    return "\n".join(lines)
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] PeerClass1 PeerClass2 ..."
+    parser = OptionParser(usage=usage_msg)
+
+    def usage(msg):
+        print(("Error: %s\n" % msg))
+        parser.print_help()
+        sys.exit(1)
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'debug', 'info' or 'warning'")
+
+    parser.add_option("--format",
+                      dest="format", default="round-robin",
+                      help="How to pair the classes up: %s" %
+                      ", ".join(FORMATS))
+
+    parser.add_option("--size",
+                      dest="size", default=4, type="int",
+                      help="Peers of each class in a matchup")
+
+    parser.add_option("--extra",
+                      dest="extra", default="Seed,2",
+                      help="Peers added to every matchup, e.g. 'Seed,2' or"
+                      " 'Seed,2 Dummy,3'.  Not ranked")
+
+    parser.add_option("--iters",
+                      dest="iters", default=10, type="int",
+                      help="Iterations of each matchup")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to spread iterations across")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Base seed for the whole tournament")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default=32, type="int",
+                      help="Set number of pieces in the file")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default=4, type="int",
+                      help="Set number of blocks per piece")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=500, type="int",
+                      help="Limit on number of rounds")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default=4, type="int",
+                      help="Min bandwidth in blocks / round")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default=10, type="int",
+                      help="Max bandwidth in blocks / round")
+
+    parser.add_option("--engine",
+                      dest="engine", default="lists",
+                      help="Swarm state engine: 'lists' or 'numpy'")
+
+    parser.add_option("--validation",
+                      dest="validation", default="full",
+                      help="Check agents' requests and uploads: 'full',"
+                      " 'sampled' or 'off'")
+
+    parser.add_option("--cache",
+                      dest="cache", default=None,
+                      help="Result cache directory to reuse iterations from"
+                      " (see cache.py)")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=100, type="float",
+                      help="Keep the --cache under this many megabytes")
+
+    parser.add_option("--out",
+                      dest="out", default=None,
+                      help="Also write every matchup's results and the"
+                      " ranking to this file as JSON")
+
+    (options, args) = parser.parse_args(args[1:])
+    if options.format not in FORMATS:
+        usage("Unknown format: %s" % options.format)
+    if len(args) < (1 if options.format == "all-vs-all" else 2):
+        usage("Need more agent classes for %s" % options.format)
+    if len(set(args)) != len(args):
+        usage("Each agent class should be listed once")
+    if options.size < 1:
+        usage("--size must be at least 1")
+    if options.iters < 1:
+        usage("--iters must be at least 1")
+    try:
+        extra = parse_agents(options.extra.split())
+        make_matchups(args, options.format, options.size, extra)
+    except ValueError as e:
+        usage(e)
+
+    configure_logging(options.loglevel)
+    (played, ranking) = run_tournament(
+        args, options.format, options.size, extra,
+        iters=options.iters, workers=options.workers, seed=options.seed,
+        num_pieces=options.num_pieces,
+        blocks_per_piece=options.blocks_per_piece,
+        max_round=options.max_round, min_up_bw=options.min_up_bw,
+        max_up_bw=options.max_up_bw, engine=options.engine,
+        validation=options.validation, cache=options.cache,
+        cache_size=options.cache_size)
+
+    logging.warning("======== RANKING ========")
+    logging.warning(format_ranking(ranking))
+    if options.out:
+        with open(options.out, "w") as f:
+            json.dump({"format": options.format, "matchups": played,
+                       "ranking": ranking}, f, sort_keys=True, indent=1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
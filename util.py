@@ -5,6 +5,8 @@
 # http://stackoverflow.com/questions/5098580/implementing-argmax-in-python
 
 from itertools import count
+import os
+import hashlib
 import math
 
 
@@ -56,6 +58,52 @@ def median(numeric):
 
 
 
+def derive_seed(base_seed, i):
+    """
+    Return a deterministic seed for iteration i of a run seeded with
+    base_seed.  Nearby base seeds and iterations give unrelated seeds.
+    """
+    digest = hashlib.sha256(("%d:%d" % (base_seed, i)).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def int_if_whole(x):
+    """
+    Values come back from a float column as floats, even when they were
+    ints; turn those back into ints
+    """
+    if type(x) is float and x.is_integer():
+        return int(x)
+    return x
+
+
+def hash_seed():
+    """
+    PYTHONHASHSEED, or None if it isn't pinned.  Agents that iterate over
+    sets visit them in an order that depends on it, so a run's seed only
+    reproduces it under the same PYTHONHASHSEED.
+    """
+    value = os.environ.get("PYTHONHASHSEED")
+    if value in (None, "", "random"):
+        return None
+    return value
+
+
+def percentile(numeric, p):
+    """
+    Nearest-rank percentile: the smallest value with at least p percent of
+    the values at or below it.  Throws an exception if the list is empty.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 95)
+    4
+    """
+    vals = sorted(numeric)
+    rank = int(math.ceil(p / 100.0 * len(vals)))
+    return vals[max(rank, 1) - 1]
+
+
 def even_split(n, k):
     """
     n and k must be ints.
@@ -112,6 +160,29 @@ class Params:
         
 
 
+def iteration_path(path, iteration, iters):
+    """
+    The file for one iteration of a run that saves a file per iteration:
+    path itself if there's only one, otherwise e.g. run.3.ext for run.ext
+    """
+    if iters == 1:
+        return path
+    (base, ext) = os.path.splitext(path)
+    return "%s.%d%s" % (base, iteration, ext)
+
+
+class Constant:
+    """
+    A callable that always returns value.  Use it instead of lambda: value
+    as a defaultdict factory in agent state, since lambdas can't be pickled.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
 class IllegalUpload(Exception):
     pass
 
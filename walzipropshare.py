@@ -17,7 +17,7 @@ from peer import Peer
 
 class WalziPropShare(Peer):
     def post_init(self):
-        print(("post_init(): %s here!" % self.id))
+        logging.debug("post_init(): %s here!", self.id)
         self.dummy_state = dict()
         self.dummy_state["cake"] = "lie"
 
@@ -33,32 +33,23 @@ class WalziPropShare(Peer):
         needed = lambda pid: self.pieces[pid] < self.conf.blocks_per_piece
         needed_pieces_list = filter(needed, [x for x in range(num_pieces)])
 
-        # Counting how rare pieces are
-        piece_availability = [0] * num_pieces
-        for peer in peers:
-            for piece in peer.available_pieces:
-                piece_availability[piece] += 1
-
-        rarity_key = lambda pid: piece_availability[pid]
-
-        # Divide pieces by their rarity
-        pieces_by_rarity = [set() for _ in range(len(peers) + 1)]
-        for needed_piece in needed_pieces_list:
-            pieces_by_rarity[rarity_key(needed_piece)].add(needed_piece)
+        pieces_by_rarity = self.needed_by_rarity(needed_pieces_list)
 
         # Create Requests
         requests = []
 
         for peer in peers:
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             remaining_requests = self.max_requests
 
             # ASSUMPTION that between equally rare pieces, we randomly choose which ones to request from a given peer
             for pieces_in_rarity_group in pieces_by_rarity:
-                isect = av_set.intersection(pieces_in_rarity_group)
+                if remaining_requests == 0:
+                    break
+                isect = av_set & pieces_in_rarity_group
                 n = min(remaining_requests, len(isect))
 
-                for piece_id in random.sample(isect, n):
+                for piece_id in random.sample(sorted(isect), n):
                     start_block = self.pieces[piece_id]
                     r = Request(self.id, peer.id, piece_id, start_block)
                     requests.append(r)
@@ -87,21 +78,18 @@ class WalziPropShare(Peer):
 
         total_blocks = 0
 
-        requesters = set()
-        for request in requests:
-            requesters.add(request.requester_id)
+        requesters = set(requests.requester_ids())
         received_from = defaultdict(lambda: 0)
 
         random_selection_set = set()
 
-        ## look at history.downloads[round-1] and find the total number of uploads
-        last_round_downloads = history.downloads[round - 1] if round > 0 else []
+        ## look at what we got last round and find the total number of uploads
+        last_round_received = history.received_from(window=1)
         for requester in requesters:
             ## we only upload the peers who request from us
-            for peer_tuple in last_round_downloads:
-                if peer_tuple.from_id == requester:
-                    total_blocks += peer_tuple.blocks
-                    received_from[requester] += peer_tuple.blocks
+            blocks = last_round_received.get(requester, 0)
+            total_blocks += blocks
+            received_from[requester] += blocks
 
             if received_from[requester] == 0:
                 random_selection_set.add(requester)
@@ -10,11 +10,16 @@ import random
 import logging
 from collections import defaultdict
 
-from messages import Upload, Request
+from messages import Upload, RequestBatch
 from util import even_split
 from peer import Peer
 
 class WalziStd(Peer):
+    # Frees its unchoke slots in rounds nobody requests from it
+    idle_calls = ("uploads",)
+    # Ranks peers by what they sent over the last 20 rounds
+    lookback = 20
+
     def post_init(self):
         self.regular_slots = set()
         self.optimistic_unchoke = set()
@@ -23,52 +28,58 @@ class WalziStd(Peer):
         self.period = 5
         self.r = 3 # Number of periods between optimisitc unchokes
 
-        print(("post_init(): %s here!" % self.id))
+        logging.debug("post_init(): %s here!", self.id)
     
     def requests(self, peers, history):
         """
         peers: available info about the peers (who has what pieces)
         history: what's happened so far as far as this peer can see
-        returns: a list of Request() objects
+        returns: a RequestBatch of this round's requests
         This will be called after update_pieces() with the most recent state.
+
+        Peers that upload fractional bandwidth leave us with fractional
+        blocks, which we ask for as fractional starts:
+
+        >>> import sim
+        >>> class HalfUp(WalziStd):
+        ...     def uploads(self, requests, peers, history):
+        ...         ups = WalziStd.uploads(self, requests, peers, history)
+        ...         return [Upload(u.from_id, u.to_id, u.bw / 2.0) for u in ups]
+        >>> for engine in ("lists", "numpy"):
+        ...     random.seed(1)
+        ...     conf = sim.make_config(["Seed", "WalziStd", "WalziStd"],
+        ...                            max_round=30, engine=engine)
+        ...     conf.agent_classes["WalziStd"] = HalfUp
+        ...     history = sim.Sim(conf).run_sim_once()
+        ...     print(sorted(history.round_done))
+        ['Seed0', 'WalziStd0', 'WalziStd1']
+        ['Seed0', 'WalziStd0', 'WalziStd1']
         """
         num_pieces = len(self.pieces)
 
         needed = lambda pid: self.pieces[pid] < self.conf.blocks_per_piece
         needed_pieces_list = list(filter(needed, [x for x in range(num_pieces)]))
         
-        # Counting how rare pieces are
-        piece_availability = [0] * num_pieces
-        for peer in peers:
-            for piece in peer.available_pieces:
-                piece_availability[piece] += 1
-
-        rarity_key = lambda pid: piece_availability[pid]
-
-        # Divide pieces by their rarity
-        pieces_by_rarity = [set() for _ in range(len(peers) + 1)]
-        for needed_piece in needed_pieces_list:
-            pieces_by_rarity[rarity_key(needed_piece)].add(needed_piece)
-
-        # for i, pieces_in_rarity_group in enumerate(pieces_by_rarity):
-        #    print("Rarity group %d: %s\n"%(i, str(pieces_in_rarity_group)))
+        pieces_by_rarity = self.needed_by_rarity(needed_pieces_list)
 
-        # Create Requests
-        requests = []
+        # Create Requests, as a batch: with a big swarm there are thousands
+        requests = RequestBatch(self.id)
+        peer_index = self.swarm.peer_index
 
         for peer in peers:
-            av_set = set(peer.available_pieces)
+            j = peer_index[peer.id]
+            av_set = peer.available_pieces
             remaining_requests = self.max_requests
 
             # ASSUMPTION that between equally rare pieces, we randomly choose which ones to request from a given peer
             for pieces_in_rarity_group in pieces_by_rarity:
-                isect = av_set.intersection(pieces_in_rarity_group)
+                if remaining_requests == 0:
+                    break
+                isect = av_set & pieces_in_rarity_group
                 n = min(remaining_requests, len(isect))
 
-                for piece_id in random.sample(isect, n):
-                    start_block = self.pieces[piece_id]
-                    r = Request(self.id, peer.id, piece_id, start_block)
-                    requests.append(r)
+                for piece_id in random.sample(sorted(isect), n):
+                    requests.add(j, piece_id, self.pieces[piece_id])
 
                 remaining_requests -= n
 
@@ -90,12 +101,9 @@ class WalziStd(Peer):
 
         round = history.current_round()
 
-        # Do some preprocessing of incoming requests
-        amount_requested = defaultdict(lambda: 0)
-        peers_requesting = set()
-        for request in requests:
-            peers_requesting.add(request.requester_id)
-            amount_requested[request.requester_id] += self.conf.blocks_per_piece - request.start
+        # The sim hands us per-requester totals along with the requests
+        amount_requested = requests.requested_blocks
+        peers_requesting = set(requests.requester_ids())
 
 
         # If a peer is no longer requesting, free the slot
@@ -111,10 +119,8 @@ class WalziStd(Peer):
             # The random initialization is a trick to break ties between same average/cumulative downloads
             download_total = defaultdict(lambda: random.uniform(0, 1))
 
-            for rounds_past in range(1, min(round, 21)): # 21 to make the total number of rounds added up equal 20
-                for download in history.downloads[round - 1]:
-                    if download.to_id == self.id: # Probably unnecessary check but just in case
-                        download_total[download.from_id] += download.blocks
+            for (peer, blocks) in history.received_from(window=20).items():
+                download_total[peer] += blocks
 
             # Completely restart the decision on these key rounds
             if round % self.period == 0:
@@ -11,10 +11,15 @@ import logging
 from collections import defaultdict
 
 from messages import Upload, Request
-from util import even_split
+from util import even_split, Constant
 from peer import Peer
 
 class WalziTourney(Peer):
+    # Keeps reputations up to date every round, requests or not
+    idle_calls = ("uploads",)
+    # Weighs what peers sent over the last 1, 2 and 3 rounds
+    lookback = 3
+
     def post_init(self):
         self.regular_slots = set()
         self.optimistic_unchoke = set()
@@ -28,16 +33,18 @@ class WalziTourney(Peer):
         expected_bw = (min_up_bw + max_up_bw) / 2
         init_alpha_estimate = expected_bw / 4 # Assuming evenly divided among 4 slots
 
-        self.reputation = defaultdict(lambda: init_alpha_estimate)
+        # Constant rather than lambda, so the agent can be pickled into a
+        # checkpoint.
+        self.reputation = defaultdict(Constant(init_alpha_estimate))
 
-        self.sum = defaultdict(lambda: 0)
-        self.n = defaultdict(lambda: 0)
+        self.sum = defaultdict(int)
+        self.n = defaultdict(int)
         # Number of pieces we want before resorting to rarity algorithm. Before this point we just try to get to this many pieces ASAP
         self.threshold_pieces = 5 #len(self.pieces) / 6
 
 
 
-        print(("post_init(): %s here!" % self.id))
+        logging.debug("post_init(): %s here!", self.id)
 
     def requests(self, peers, history):
         """
@@ -71,32 +78,23 @@ class WalziTourney(Peer):
                 requests.extend(peer_requests)
         else:
             
-            # Counting how rare pieces are
-            piece_availability = [0] * num_pieces
-            for peer in peers:
-                for piece in peer.available_pieces:
-                    piece_availability[piece] += 1
-
-            rarity_key = lambda pid: piece_availability[pid]
-
-            # Divide pieces by their rarity
-            pieces_by_rarity = [set() for _ in range(len(peers) + 1)]
-            for needed_piece in needed_pieces_list:
-                pieces_by_rarity[rarity_key(needed_piece)].add(needed_piece)
+            pieces_by_rarity = self.needed_by_rarity(needed_pieces_list)
 
             # Create Requests
             requests = []
 
             for peer in peers:
-                av_set = set(peer.available_pieces)
+                av_set = peer.available_pieces
                 remaining_requests = self.max_requests
 
                 # ASSUMPTION that between equally rare pieces, we randomly choose which ones to request from a given peer
                 for pieces_in_rarity_group in pieces_by_rarity:
-                    isect = av_set.intersection(pieces_in_rarity_group)
+                    if remaining_requests == 0:
+                        break
+                    isect = av_set & pieces_in_rarity_group
                     n = min(remaining_requests, len(isect))
 
-                    for piece_id in random.sample(isect, n):
+                    for piece_id in random.sample(sorted(isect), n):
                         start_block = self.pieces[piece_id]
                         r = Request(self.id, peer.id, piece_id, start_block)
                         requests.append(r)
@@ -141,8 +139,7 @@ class WalziTourney(Peer):
 
         current_received_from = defaultdict(lambda: 0)
         if round - 1 > 0:
-            for download in history.downloads[round - 1]:
-                current_received_from[download.from_id] += download.blocks
+            current_received_from.update(history.received_from(window=1))
 
         random_selection_set = set()
 
@@ -152,26 +149,22 @@ class WalziTourney(Peer):
                 self.sum[peer] += current_received_from[peer]
                 self.reputation[peer] = self.sum[peer]/self.n[peer]
                 # print("REP is: " + str(self.reputation[peer]) + " for " + str(peer))
-        ## look at history.downloads[round-1] and find the total number of uploads
-        last_round_downloads_1 = history.downloads[round - 1] if round > 0 else []
-        last_round_downloads_2 = history.downloads[round - 2] if round > 1 else []
-        last_round_downloads_3 = history.downloads[round - 3] if round > 2 else []
+        ## look at the last three rounds of downloads, weighting the most
+        ## recent ones more: 3x last round, 2x the one before, 1x the third.
+        ## The windows overlap, so summing them gives exactly those weights.
+        received_1 = history.received_from(window=1)
+        received_2 = history.received_from(window=2)
+        received_3 = history.received_from(window=3)
 
-        
         for requester in requesters:
             ## we only upload the peers who request from us
-            for peer_tuple in last_round_downloads_1:
-                if peer_tuple.from_id == request.requester_id:
-                    total_blocks += 3 * peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
-                    received_from[requester] += 3 * peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
-            for peer_tuple in last_round_downloads_2:
-                if peer_tuple.from_id == request.requester_id:
-                    total_blocks += 2 * peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
-                    received_from[requester] += 2 * peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
-            for peer_tuple in last_round_downloads_3:
-                if peer_tuple.from_id == request.requester_id:
-                    total_blocks += peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
-                    received_from[requester] += peer_tuple.blocks * self.reputation[peer_tuple.from_id] / 10
+            weighted = (received_1.get(requester, 0) +
+                        received_2.get(requester, 0) +
+                        received_3.get(requester, 0))
+            if weighted > 0:
+                blocks = weighted * self.reputation[requester] / 10
+                total_blocks += blocks
+                received_from[requester] += blocks
 
             if received_from[requester] == 0:
                 random_selection_set.add(requester)
@@ -11,10 +11,13 @@ import logging
 
 from collections import defaultdict
 from messages import Upload, Request
-from util import even_split
+from util import even_split, Constant
 from peer import Peer
 
 class WalziTyrant(Peer):
+    # Updates its rate estimates every round, requests or not
+    idle_calls = ("uploads",)
+
     def post_init(self):
         self.r = 3
         self.gamma = 0.1
@@ -30,15 +33,16 @@ class WalziTyrant(Peer):
         init_d_estimate = expected_bw / 4 # Assuming evenly divided among 4 slots
         init_u_estimate = self.up_bw / 4 # Arbitrary assumption so that we unchoke 4 at the start
 
-        # The estimates stored as dicts
-        self.d = defaultdict(lambda: init_d_estimate)
-        self.u = defaultdict(lambda: init_u_estimate)
+        # The estimates stored as dicts.  (Constant rather than lambda, so
+        # the agent can be pickled into a checkpoint.)
+        self.d = defaultdict(Constant(init_d_estimate))
+        self.u = defaultdict(Constant(init_u_estimate))
         self.unchoked = set()
-        self.time_unchoked_by = defaultdict(lambda: 0)
+        self.time_unchoked_by = defaultdict(int)
 
         if self.debug:
             print("Config: %s"%self.conf)
-        print(("post_init(): %s here!" % self.id))
+        logging.debug("post_init(): %s here!", self.id)
     
     def requests(self, peers, history):
         """
@@ -52,32 +56,23 @@ class WalziTyrant(Peer):
         needed = lambda pid: self.pieces[pid] < self.conf.blocks_per_piece
         needed_pieces_list = list(filter(needed, [x for x in range(num_pieces)]))
         
-        # Counting how rare pieces are
-        piece_availability = [0] * num_pieces
-        for peer in peers:
-            for piece in peer.available_pieces:
-                piece_availability[piece] += 1
-
-        rarity_key = lambda pid: piece_availability[pid]
-
-        # Divide pieces by their rarity
-        pieces_by_rarity = [set() for _ in range(len(peers) + 1)]
-        for needed_piece in needed_pieces_list:
-            pieces_by_rarity[rarity_key(needed_piece)].add(needed_piece)
+        pieces_by_rarity = self.needed_by_rarity(needed_pieces_list)
 
         # Create Requests
         requests = []
 
         for peer in peers:
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             remaining_requests = self.max_requests
 
             # ASSUMPTION that between equally rare pieces, we randomly choose which ones to request from a given peer
             for pieces_in_rarity_group in pieces_by_rarity:
-                isect = av_set.intersection(pieces_in_rarity_group)
+                if remaining_requests == 0:
+                    break
+                isect = av_set & pieces_in_rarity_group
                 n = min(remaining_requests, len(isect))
 
-                for piece_id in random.sample(isect, n):
+                for piece_id in random.sample(sorted(isect), n):
                     start_block = self.pieces[piece_id]
                     r = Request(self.id, peer.id, piece_id, start_block)
                     requests.append(r)
@@ -102,9 +97,7 @@ class WalziTyrant(Peer):
         received_from = defaultdict(lambda: 0)
 
         if round - 1 > 0:
-            for download in history.downloads[round - 1]:
-                received_from[download.from_id] += download.blocks
-            # print("Received %d from %s"%(download.blocks, download.from_id))
+            received_from.update(history.received_from(window=1))
 
         for peer in received_from.keys():
             if received_from[peer] > 0: